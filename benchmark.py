@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+Fingerprint throughput and collision benchmarks.
+
+Generates a corpus of realistic Node.js (t2-cli) stack traces (short, huge, near duplicates and unicode),
+and reports throughput, peak allocations per trace and the collision / split rates of every fingerprinting mode as JSON,
+so hashing changes can be compared across commits.
+
+    python benchmark.py --traces 2000 --output bench_output.txt
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+from frames import frame_sim_hash
+from normalizer import get_normalizer
+from simhash import hamming_distance, legacy_sim_hash, parse_fingerprint, permuted_blocks, sim_hash
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+MESSAGES = [
+    u'Error: connect ECONNREFUSED 192.168.1.101:22',
+    u'TypeError: Cannot read property \'write\' of undefined',
+    u'Error: No Tessels Found.',
+    u'RangeError: Maximum call stack size exceeded',
+    u'Error: spawn rsync ENOENT',
+    u'SyntaxError: Unexpected token }} in JSON at position 0x{address}',
+    u'Error: Timed out waiting for the Tessel to respond',
+    u'Error: Impossible de se connecter à la carte Tessel (« {address} »)',
+    u'Error: 无法连接到 Tessel 设备',
+    u'TypeError: usb.getDeviceList is not a function',
+]
+
+APP_FILES = [
+    u'lib/tessel/deploy.js', u'lib/tessel/provision.js', u'lib/tessel/wifi.js', u'lib/controller.js',
+    u'lib/usb-connection.js', u'lib/lan-connection.js', u'lib/tessel/commands.js', u'bin/tessel-2.js',
+    u'lib/tessel/tessel.js', u'lib/update-fetch.js', u'lib/crash-reporter.js', u'lib/tessel/access-point.js',
+]
+
+APP_FUNCTIONS = [
+    u'deploy', u'provision', u'connectToNetwork', u'runScript', u'findTessel', u'closeTesselConnections',
+    u'Tessel.connectToNetwork', u'Controller.standardTesselCommand', u'USBConnection.open', u'LAN.Scanner.start',
+    u'actions.writeProjectFiles', u'Socket.onData', u'Tessel.getName', u'logAndFinish',
+]
+
+CORE_FRAMES = [
+    (u'Timer.listOnTimeout [as ontimeout]', u'timers.js'),
+    (u'emitOne', u'events.js'),
+    (u'Socket.emit', u'events.js'),
+    (u'process._tickCallback', u'node.js'),
+    (u'Module._compile', u'module.js'),
+    (u'TCPConnectWrap.afterConnect [as oncomplete]', u'net.js'),
+]
+
+INSTALL_PREFIXES = [
+    u'/usr/local/lib/node_modules/t2-cli/',
+    u'/home/{user}/.nvm/versions/node/v4.2.1/lib/node_modules/t2-cli/',
+    u'C:\\Users\\{user}\\AppData\\Roaming\\npm\\node_modules\\t2-cli\\',
+    u'/Users/{user}/projects/t2-cli/',
+]
+
+USERS = [u'pi', u'rahul', u'ana', u'kelsey', u'jon']
+
+RECEIVERS = [u'', u'null.', u'Object.', u'console.']
+
+WARMUP_TRACE = u'Error: warm up\n    at warmUp (/usr/local/lib/node_modules/t2-cli/lib/warm-up.js:1:1)'
+
+
+def render_frame(rng, frame, prefix, user):
+    function, file_name, app_frame, line, column = frame
+    receiver = rng.choice(RECEIVERS) if app_frame else u''
+    if app_frame:
+        path = prefix.format(user=user) + file_name
+        if '\\' in prefix:
+            path = path.replace('/', '\\')
+    else:
+        path = file_name
+    return u'    at {0}{1} ({2}:{3}:{4})'.format(receiver, function, path, line, column)
+
+
+class Bug(object):
+    """
+    A unique crash. Reports of the same bug differ in install paths, columns, receivers and addresses.
+    """
+    def __init__(self, rng, bug_id, messages=MESSAGES, frames=8):
+        self.bug_id = bug_id
+        self.message = rng.choice(messages)
+        self.frames = list()
+        for i in range(frames):
+            if rng.random() < 0.7:
+                function, file_name, app_frame = rng.choice(APP_FUNCTIONS), rng.choice(APP_FILES), True
+            else:
+                (function, file_name), app_frame = rng.choice(CORE_FRAMES), False
+            self.frames.append((function, file_name, app_frame, rng.randint(1, 400), rng.randint(1, 80)))
+
+    def report(self, rng, repeat_frames=1, frames=None):
+        prefix = rng.choice(INSTALL_PREFIXES)
+        user = rng.choice(USERS)
+        lines = [self.message.format(address='%012x' % rng.getrandbits(48))]
+        for i in range(repeat_frames):
+            for frame in (frames or self.frames):
+                lines.append(render_frame(rng, frame, prefix, user))
+        return u'\n'.join(lines)
+
+    def near_duplicate(self, rng):
+        """
+        The same bug, reported from a slightly different version of the CLI (one frame has moved).
+        """
+        frames = list(self.frames)
+        index = rng.randint(0, len(frames) - 1)
+        function, file_name, app_frame, line, column = frames[index]
+        frames[index] = (function, file_name, app_frame, line + rng.randint(1, 5), column)
+        return self.report(rng, frames=frames)
+
+
+def generate_corpus(traces, seed=42):
+    """
+    Returns a dict of corpus name -> list of (bug id, trace) tuples.
+    """
+    rng = random.Random(seed)
+    unique_bugs = max(1, traces // 20)
+    bugs = [Bug(rng, bug_id) for bug_id in range(unique_bugs)]
+    unicode_messages = [message for message in MESSAGES if any(ord(c) > 127 for c in message)]
+    unicode_bugs = [Bug(rng, bug_id, messages=unicode_messages) for bug_id in range(unique_bugs)]
+    corpus = {
+        'short': [(bug.bug_id, bug.report(rng)) for bug in (rng.choice(bugs) for i in range(traces))],
+        'near_duplicates': [(bug.bug_id, bug.near_duplicate(rng)) for bug in
+                            (rng.choice(bugs) for i in range(traces))],
+        'unicode': [(bug.bug_id, bug.report(rng)) for bug in (rng.choice(unicode_bugs) for i in range(traces))],
+        # runaway recursion dumps
+        'huge': [(bug.bug_id, bug.report(rng, repeat_frames=2000)) for bug in
+                 (rng.choice(bugs) for i in range(max(1, traces // 100)))],
+    }
+    return corpus
+
+
+class NearDuplicateTable(object):
+    """
+    An in-memory version of the permuted-prefix table in model.FingerprintBucket.
+    """
+    def __init__(self):
+        self.buckets = dict()
+
+    def resolve(self, fingerprint):
+        value = parse_fingerprint(fingerprint)
+        if value is None:
+            return fingerprint
+        blocks = permuted_blocks(value)
+        candidates = set()
+        for block in blocks:
+            candidates.update(self.buckets.get(block, ()))
+        matches = sorted((hamming_distance(value, parse_fingerprint(candidate)), candidate)
+                         for candidate in candidates)
+        if matches and matches[0][0] <= len(blocks) - 1:
+            return matches[0][1]
+        for block in blocks:
+            self.buckets.setdefault(block, list()).append(fingerprint)
+        return fingerprint
+
+
+def modes():
+    normalizer = get_normalizer()
+    return [
+        ('legacy', lambda trace: legacy_sim_hash(trace), False),
+        ('sim_hash', lambda trace: sim_hash(trace), False),
+        ('normalized', lambda trace: sim_hash(trace, normalizer=normalizer), False),
+        ('normalized_near_duplicates', lambda trace: sim_hash(trace, normalizer=normalizer), True),
+        ('top_frames', lambda trace: frame_sim_hash(trace, 5, normalizer=normalizer) or
+                                     sim_hash(trace, normalizer=normalizer), False),
+    ]
+
+
+def peak_allocation_per_trace(function, traces):
+    """
+    The largest amount of memory allocated (at its peak) while fingerprinting a single trace, in bytes.
+    Returns a tuple of (metric name, value), as Python 2.7 (the runtime of the app) has no tracemalloc:
+      peak_allocation_per_trace: measured with tracemalloc, whose peak is reset before every trace
+      peak_rss_growth_per_trace: the growth of the peak resident set size of a child process forked for every
+        trace. It only sees memory that the allocator could not reuse, and is a multiple of the page size
+        (so short traces usually report 0).
+    """
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            peak = 0
+            for trace in traces:
+                if hasattr(tracemalloc, 'reset_peak'):
+                    tracemalloc.reset_peak()
+                else:
+                    # also resets the peak
+                    tracemalloc.clear_traces()
+                baseline = tracemalloc.get_traced_memory()[0]
+                function(trace)
+                peak = max(peak, tracemalloc.get_traced_memory()[1] - baseline)
+        finally:
+            tracemalloc.stop()
+        return 'peak_allocation_per_trace', peak
+    if resource is None or not hasattr(os, 'fork'):
+        return 'peak_allocation_per_trace', None
+    return 'peak_rss_growth_per_trace', max(rss_growth(function, trace) for trace in traces)
+
+
+def rss_growth(function, trace):
+    """
+    The growth of the peak resident set size (in bytes) of a forked child process, that fingerprints the trace.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # child: measure, report and exit without running any cleanup of the parent
+        try:
+            os.close(read_fd)
+            # touch the code and the caches used by the function, so that faulting them in is not measured
+            function(WARMUP_TRACE)
+            gc.collect()
+            baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            function(trace)
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # ru_maxrss is in kilobytes on Linux, and in bytes on OS X
+            unit = 1 if sys.platform == 'darwin' else 1024
+            os.write(write_fd, str((peak - baseline) * unit).encode('ascii'))
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as f:
+        output = f.read()
+    os.waitpid(pid, 0)
+    return int(output) if output else 0
+
+
+def rates(bug_ids, fingerprints):
+    """
+    split rate = fraction of bugs with more than one fingerprint
+    collision rate = fraction of fingerprints shared by more than one bug
+    fingerprints per bug = average number of fingerprints of a bug (tells a few stray fingerprints apart
+    from a bug that gets a new fingerprint on every report, which have the same split rate)
+    """
+    fingerprints_by_bug = dict()
+    bugs_by_fingerprint = dict()
+    for bug_id, fingerprint in zip(bug_ids, fingerprints):
+        fingerprints_by_bug.setdefault(bug_id, set()).add(fingerprint)
+        bugs_by_fingerprint.setdefault(fingerprint, set()).add(bug_id)
+    split = len([bug for bug, values in fingerprints_by_bug.items() if len(values) > 1])
+    collisions = len([fingerprint for fingerprint, values in bugs_by_fingerprint.items() if len(values) > 1])
+    return {
+        'bugs': len(fingerprints_by_bug),
+        'fingerprints': len(bugs_by_fingerprint),
+        'split_rate': float(split) / len(fingerprints_by_bug),
+        'fingerprints_per_bug': sum(len(values) for values in fingerprints_by_bug.values()) /
+        float(len(fingerprints_by_bug)),
+        'collision_rate': float(collisions) / len(bugs_by_fingerprint)
+    }
+
+
+def benchmark(corpus):
+    results = dict()
+    for mode, function, near_duplicates in modes():
+        results[mode] = dict()
+        for name, entries in sorted(corpus.items()):
+            bug_ids = [bug_id for bug_id, trace in entries]
+            traces = [trace for bug_id, trace in entries]
+            start = time.time()
+            fingerprints = [function(trace) for trace in traces]
+            if near_duplicates:
+                table = NearDuplicateTable()
+                fingerprints = [table.resolve(fingerprint) for fingerprint in fingerprints]
+            elapsed = time.time() - start
+            metric, allocation = peak_allocation_per_trace(function, traces)
+            result = {
+                'traces': len(traces),
+                'traces_per_second': len(traces) / elapsed if elapsed > 0 else None,
+                metric: allocation
+            }
+            result.update(rates(bug_ids, fingerprints))
+            results[mode][name] = result
+    return results
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fingerprint throughput and collision benchmarks.')
+    parser.add_argument('--traces', type=int, default=1000, help='number of traces per corpus')
+    parser.add_argument('--seed', type=int, default=42, help='seed for the generated corpus')
+    parser.add_argument('--output', help='write the JSON results to a file instead of stdout')
+    args = parser.parse_args()
+
+    results = {
+        'commit': commit(),
+        'python': sys.version.split()[0],
+        'traces': args.traces,
+        'seed': args.seed,
+        'results': benchmark(generate_corpus(args.traces, seed=args.seed))
+    }
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
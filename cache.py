@@ -0,0 +1,376 @@
+import functools
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from google.appengine.api import memcache
+
+
+class LRUCache(object):
+    """
+    A bounded, thread safe, in-process least recently used cache. Items expire after ttl seconds (if specified).
+    """
+    def __init__(self, capacity=1024, ttl=None):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._items:
+                value, expires = self._items.pop(key)
+                if expires is None or expires > time.time():
+                    # mark as most recently used
+                    self._items[key] = (value, expires)
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (value, time.time() + ttl if ttl else None)
+            while len(self._items) > self.capacity:
+                # evict the least recently used item
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._items),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits) / lookups if lookups > 0 else 0.0
+        }
+
+
+# marks a miss, so that None can be cached
+MISSING = object()
+
+
+class TwoTierCache(object):
+    """
+    A per-instance LRU (with a TTL) in front of memcache. Every namespace has a generation counter in memcache,
+    which is part of every memcache key. Invalidating a namespace bumps its generation, so every instance stops
+    using the old values: memcache values become unreachable right away, and in-process values are dropped when
+    the instance next checks the generation (at most every generation_ttl seconds).
+    """
+    __GENERATION_PREFIX__ = 'generation_'
+
+    # namespace -> cache, to expose the statistics of every cache
+    instances = dict()
+
+    def __init__(self, namespace, capacity=1024, local_ttl=60, ttl=3600, generation_ttl=5):
+        self.namespace = namespace
+        self.local = LRUCache(capacity=capacity, ttl=local_ttl)
+        self.ttl = ttl
+        self.generation_ttl = generation_ttl
+        self.memcache_hits = 0
+        self.memcache_misses = 0
+        self._generation = None
+        self._generation_checked = 0
+        TwoTierCache.instances[namespace] = self
+
+    def generation_key(self):
+        return TwoTierCache.__GENERATION_PREFIX__ + self.namespace
+
+    def generation(self):
+        now = time.time()
+        if self._generation is None or now - self._generation_checked > self.generation_ttl:
+            generation_key = self.generation_key()
+            generation = memcache.get(generation_key)
+            if generation is None:
+                # start from the current time, so an evicted generation never goes back to an older value
+                memcache.add(generation_key, int(now * 1000))
+                generation = memcache.get(generation_key) or int(now * 1000)
+            if generation != self._generation:
+                self.local.clear()
+            self._generation = generation
+            self._generation_checked = now
+        return self._generation
+
+    def memcache_key(self, key, generation):
+        return '{0}:{1}:{2}'.format(self.namespace, generation, key)
+
+    def get_multi(self, keys, local=True):
+        """
+        Returns a dict of key -> value for the keys that are cached. local=False skips the in-process tier.
+        """
+        generation = self.generation()
+        found = dict()
+        missing = list()
+        for key in keys:
+            value = self.local.get(key, MISSING) if local else MISSING
+            if value is MISSING:
+                missing.append(key)
+            else:
+                found[key] = value
+        if missing:
+            memcache_keys = dict((self.memcache_key(key, generation), key) for key in missing)
+            cached = memcache.get_multi(memcache_keys.keys())
+            self.memcache_hits += len(cached)
+            self.memcache_misses += len(missing) - len(cached)
+            for memcache_key, value in cached.iteritems():
+                key = memcache_keys.get(memcache_key)
+                self.local.set(key, value)
+                found[key] = value
+        return found
+
+    def get(self, key, default=None, local=True):
+        return self.get_multi([key], local=local).get(key, default)
+
+    def set_multi(self, mapping, ttl=None):
+        """
+        ttl overrides the memcache TTL, and caps the in-process TTL of these values.
+        """
+        generation = self.generation()
+        memcache.set_multi(
+            dict((self.memcache_key(key, generation), value) for key, value in mapping.iteritems()),
+            time=ttl or self.ttl)
+        local_ttl = min(ttl, self.local.ttl or ttl) if ttl else None
+        for key, value in mapping.iteritems():
+            self.local.set(key, value, ttl=local_ttl)
+
+    def set(self, key, value, ttl=None):
+        self.set_multi({key: value}, ttl=ttl)
+
+    def delete_multi(self, keys):
+        """
+        Deletes keys with a single memcache call. Other instances keep their in-process copies until they expire.
+        """
+        generation = self.generation()
+        memcache.delete_multi([self.memcache_key(key, generation) for key in keys])
+        for key in keys:
+            self.local.delete(key)
+
+    def delete(self, key):
+        """
+        Deletes a single key. Other instances keep their in-process copy until it expires.
+        """
+        self.delete_multi([key])
+
+    def invalidate(self):
+        """
+        Invalidates the whole namespace, in every instance.
+        """
+        if memcache.incr(self.generation_key()) is None:
+            memcache.set(self.generation_key(), int(time.time() * 1000))
+        self.local.clear()
+        self._generation = None
+
+    def stats(self):
+        lookups = self.memcache_hits + self.memcache_misses
+        return {
+            'generation': self._generation,
+            'local': self.local.stats(),
+            'memcache': {
+                'hits': self.memcache_hits,
+                'misses': self.memcache_misses,
+                'hit_ratio': float(self.memcache_hits) / lookups if lookups > 0 else 0.0
+            }
+        }
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent computations of the same key in this instance. The first caller computes the value,
+    and the other callers wait for (and share) its result.
+    """
+    # callers give up waiting, and compute the value themselves after this many seconds
+    __WAIT_TIMEOUT__ = 30
+
+    def __init__(self):
+        self.coalesced = 0
+        self._calls = dict()
+        self._lock = threading.Lock()
+
+    def do(self, key, function, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {'event': threading.Event()}
+                self._calls[key] = call
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.get('event').wait(SingleFlight.__WAIT_TIMEOUT__)
+            if 'value' in call:
+                return call.get('value')
+            # the leader failed (or is too slow)
+            return function(*args, **kwargs)
+
+        try:
+            value = function(*args, **kwargs)
+            call['value'] = value
+            return value
+        finally:
+            call.get('event').set()
+            with self._lock:
+                self._calls.pop(key, None)
+
+
+flights = SingleFlight()
+
+
+class StaleWhileRevalidate(object):
+    """
+    Single flight recomputation of memcache values. A value is fresh for soft_ttl seconds, and is then served
+    stale while exactly one request (the one that wins a memcache add on the freshness marker) recomputes it.
+    When the value is missing altogether, one request (the one that wins a memcache add on a lock) computes it,
+    and the others are served the fallback (if there is one), or wait for the computation in this instance.
+    The value itself is stored as is, so it can still be updated with incr or cas.
+    """
+    def __init__(self, soft_ttl, hard_ttl=0, lock_ttl=10):
+        self.soft_ttl = soft_ttl
+        self.hard_ttl = hard_ttl
+        self.lock_ttl = lock_ttl
+
+    @classmethod
+    def fresh_key(cls, key):
+        return key + '_fresh'
+
+    @classmethod
+    def lock_key(cls, key):
+        return key + '_lock'
+
+    def get(self, key, compute, fallback=None):
+        client = memcache.Client()
+        fresh_key = StaleWhileRevalidate.fresh_key(key)
+        cached = client.get_multi([key, fresh_key], for_cas=True)
+        value = cached.get(key)
+        if value is not None:
+            if fresh_key in cached or not client.add(fresh_key, 1, time=self.soft_ttl):
+                # fresh, or another request is already revalidating it
+                return value
+            value = flights.do(key, compute)
+            # a value updated in the meantime (e.g. incremented) wins over the recomputed one
+            client.cas(key, value, time=self.hard_ttl)
+            return value
+
+        lock_key = StaleWhileRevalidate.lock_key(key)
+        if client.add(lock_key, 1, time=self.lock_ttl):
+            try:
+                value = flights.do(key, compute)
+                client.add(key, value, time=self.hard_ttl)
+                client.set(fresh_key, 1, time=self.soft_ttl)
+                return value
+            finally:
+                client.delete(lock_key)
+        if fallback is not None:
+            return fallback()
+        return flights.do(key, compute)
+
+
+def memoize_key(version, *args, **kwargs):
+    """
+    Builds a cache key from the arguments of a call. Classes (the cls of a classmethod) are not part of the key.
+    """
+    parts = [arg for arg in args if not isinstance(arg, type)]
+    parts.extend(sorted(kwargs.items()))
+    return '{0}:{1}'.format(version, hashlib.md5(repr(parts)).hexdigest())
+
+
+def memoize(namespace, ttl=3600, local_ttl=60, negative_ttl=60, version=1):
+    """
+    Memoizes a function in a TwoTierCache. The key is built from the arguments, and the namespace and version
+    keep memoized functions apart (bump the version when the result of a function changes shape).
+    None results are cached for negative_ttl seconds (0 turns negative caching off).
+    The decorated function has:
+      invalidate(*args, **kwargs): forgets the result for the given arguments
+      invalidate_all(): forgets every result, in every instance
+    For classmethods, apply it below @classmethod.
+    """
+    cache = TwoTierCache(namespace, local_ttl=local_ttl, ttl=ttl)
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapped(*args, **kwargs):
+            key = memoize_key(version, *args, **kwargs)
+            # values are wrapped in a tuple, so None can be told apart from a miss
+            cached = cache.get(key)
+            if cached is not None:
+                return cached[0]
+            value = function(*args, **kwargs)
+            if value is not None:
+                cache.set(key, (value,))
+            elif negative_ttl > 0:
+                cache.set(key, (value,), ttl=negative_ttl)
+            return value
+
+        wrapped.invalidate = lambda *args, **kwargs: cache.delete(memoize_key(version, *args, **kwargs))
+        wrapped.invalidate_all = cache.invalidate
+        wrapped.cache = cache
+        return wrapped
+
+    return decorator
+
+
+def memoize_multi(namespace, ttl=3600, local_ttl=60, negative_ttl=60, version=1):
+    """
+    The batch variant of memoize. The decorated function takes a list of items as its last argument,
+    and returns a dict of item -> value. N lookups turn into a single memcache get_multi, and the function
+    is only called with the items that were not cached. Items missing from the result are cached as None.
+    The leading arguments are part of the key of every item.
+    The decorated function has invalidate(*args) (with the same arguments as the function) and invalidate_all().
+    """
+    cache = TwoTierCache(namespace, local_ttl=local_ttl, ttl=ttl)
+
+    def item_key(prefix, item):
+        return memoize_key(version, *(prefix + (item,)))
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapped(*args):
+            prefix, items = args[:-1], args[-1]
+            keys = dict((item_key(prefix, item), item) for item in items)
+            cached = cache.get_multi(keys.keys())
+            results = dict((keys.get(key), value[0]) for key, value in cached.iteritems())
+            missing = [item for item in items if item not in results]
+            if missing:
+                computed = function(*(prefix + (missing,)))
+                to_cache = dict()
+                negative = dict()
+                for item in missing:
+                    value = computed.get(item)
+                    results[item] = value
+                    if value is not None:
+                        to_cache[item_key(prefix, item)] = (value,)
+                    else:
+                        negative[item_key(prefix, item)] = (value,)
+                if to_cache:
+                    cache.set_multi(to_cache)
+                if negative and negative_ttl > 0:
+                    cache.set_multi(negative, ttl=negative_ttl)
+            return results
+
+        def invalidate(*args):
+            prefix, items = args[:-1], args[-1]
+            if items:
+                cache.delete_multi([item_key(prefix, item) for item in items])
+
+        wrapped.invalidate = invalidate
+        wrapped.invalidate_all = cache.invalidate
+        wrapped.cache = cache
+        return wrapped
+
+    return decorator
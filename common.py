@@ -3,7 +3,6 @@ import logging
 import os
 
 import jinja2
-from google.appengine.api import memcache
 
 from model import from_milliseconds
 from github_utils import issue_url
@@ -27,23 +26,6 @@ def common_request(callable_function):
     return wrapped_callable
 
 
-def cache_it(key=None, time=86400):
-    def decorator(callable_function):
-        def wrapped_callable(*args, **kwargs):
-            cached_value = memcache.get(key)
-            if cached_value:
-                return cached_value
-            else:
-                value = callable_function(*args, **kwargs)
-                if value is not None:
-                    memcache.set(key, value, time=time)
-                return value
-
-        return wrapped_callable
-
-    return decorator
-
-
 def readable_date(milliseconds):
     date_time = from_milliseconds(milliseconds)
     return date_time.strftime('%Y-%m-%d %H:%M:%S')
@@ -0,0 +1,90 @@
+import re
+
+from simhash import __MAX_CHARACTERS__, _iter_lines, sim_hash
+
+# at fn (file:line:col) | at file:line:col
+__FRAME__ = re.compile(r'^\s*at\s+(?:(?P<function>.+?)\s+\((?P<location>.*)\)|(?P<bare_location>\S+))\s*$')
+# file:line:col | file:line
+__LOCATION__ = re.compile(r'^(?P<file>.*?)(?::\d+){1,2}$')
+# maximum number of frames stored on a crash report
+__MAX_FRAMES__ = 32
+# maximum length of a function or file name (keeps them within datastore limits)
+__MAX_NAME_LENGTH__ = 240
+
+ANONYMOUS = '<anonymous>'
+
+
+def parse_frames(trace, normalizer=None, limit=__MAX_FRAMES__):
+    """
+    Parses V8 / Node.js stack frames, and returns a list of (function, file) tuples.
+    Lines are normalized before they are parsed when a normalizer is specified.
+    Lines are read one at a time (and only from the beginning of huge traces), so the trace is never copied.
+    """
+    frames = list()
+    if not trace:
+        return frames
+    for line in _iter_lines(trace, max_characters=__MAX_CHARACTERS__):
+        if normalizer:
+            line = normalizer.normalize_line(line)
+        match = __FRAME__.match(line)
+        if not match:
+            continue
+        if match.group('function') is not None:
+            function = match.group('function')
+            location = match.group('location')
+        else:
+            function = ANONYMOUS
+            location = match.group('bare_location')
+        # eval frames nest the location (eval at fn (file:line:col), <anonymous>:1:2)
+        if location.startswith('eval at '):
+            location = location.rsplit(', ', 1)[-1]
+        location_match = __LOCATION__.match(location)
+        file_name = location_match.group('file') if location_match else location
+        frames.append((function[:__MAX_NAME_LENGTH__], file_name[:__MAX_NAME_LENGTH__]))
+        if len(frames) >= limit:
+            break
+    return frames
+
+
+def is_in_app(frame):
+    """
+    Node core modules (timers.js, internal/..., native) are not in-app frames.
+    """
+    function, file_name = frame
+    if file_name in ('native', ANONYMOUS) or file_name.startswith('internal/'):
+        return False
+    return '/' in file_name or '\\' in file_name
+
+
+def frame_files(frames):
+    """
+    Returns the list of unique files touched by the frames. Both the path and the base name are included,
+    so crashes can be looked up by either.
+    """
+    files = list()
+    for function, file_name in frames:
+        if file_name in ('native', ANONYMOUS):
+            continue
+        for name in (file_name, file_name.replace('\\', '/').rsplit('/', 1)[-1]):
+            if name and name not in files:
+                files.append(name)
+    return files
+
+
+def serialize_frames(frames):
+    return [u'{0}\t{1}'.format(function, file_name) for function, file_name in frames]
+
+
+def deserialize_frames(serialized):
+    return [tuple(frame.split('\t', 1)) for frame in serialized]
+
+
+def frame_sim_hash(trace, top_frames, normalizer=None):
+    """
+    Computes a fingerprint over the top in-app frames of a trace.
+    Returns None, when the trace has no in-app frames.
+    """
+    in_app = [frame for frame in parse_frames(trace, normalizer=normalizer) if is_in_app(frame)][:top_frames]
+    if not in_app:
+        return None
+    return sim_hash(u'\n'.join(u'{0} {1}'.format(function, file_name) for function, file_name in in_app))
@@ -55,9 +55,10 @@ class GithubOrchestrator(object):
         return 'github_task_new_comment_{0}'.format(crash_report.fingerprint)
 
     @classmethod
-    def manage_github_issue(cls, crash_report):
+    def manage_github_issue(cls, crash_report, delta=1):
         """
-        Manages the GitHub issue.
+        Manages the GitHub issue. delta is the number of reports that were just added, so that aggregated
+        reports (e.g. 98 => 105) still notice crossing a multiple of the notification frequency.
         """
         # check global github preference
         preference_value = GlobalPreferences.get_property(GlobalPreferences.__INTEGRATE_WITH_GITHUB__, 'true')
@@ -71,7 +72,8 @@ class GithubOrchestrator(object):
             if issue is None:
                 # new crash
                 cls.new_crash_with_backoff(crash_report)
-            elif count > 0 and count % GithubOrchestrator.__NOTIFY_FREQUENCY__ == 0:
+            elif count > 0 and count // GithubOrchestrator.__NOTIFY_FREQUENCY__ > \
+                    max(0, count - delta) // GithubOrchestrator.__NOTIFY_FREQUENCY__:
                 # add comments for an existing crash
                 cls.new_comment_with_backoff(crash_report)
             else:
@@ -83,10 +85,9 @@ class GithubOrchestrator(object):
         there is a chance that we get a new crash before an issue was submitted before.
         """
         backoff_cache_key = cls.backoff_crash_key_new_crash(crash_report)
-        backoff_value = memcache.get(backoff_cache_key)
-        if not backoff_value:
+        # add only succeeds when a task does not exist (a single RPC, and no race between the get and the set)
+        if memcache.add(backoff_cache_key, "in_progress"):
             # A task does not exist. Queue a job.
-            memcache.set(backoff_cache_key, "in_progress")
             deferred.defer(
                 GithubOrchestrator.create_issue_job,
                 crash_report.fingerprint, _queue=GithubOrchestrator.__QUEUE__)
@@ -106,10 +107,9 @@ class GithubOrchestrator(object):
         try and use backoff, when you are posting a new comment.
         """
         backoff_cache_key = cls.backoff_crash_key_new_comment(crash_report)
-        backoff_value = memcache.get(backoff_cache_key)
-        if not backoff_value:
+        # add only succeeds when a task does not exist (a single RPC, and no race between the get and the set)
+        if memcache.add(backoff_cache_key, "in_progress"):
             # A task does not exist. Queue a job.
-            memcache.set(backoff_cache_key, "in_progress")
             deferred.defer(
                 GithubOrchestrator.add_comment_job,
                 crash_report.fingerprint, _queue=GithubOrchestrator.__QUEUE__)
@@ -5,12 +5,14 @@ import logging
 import urllib
 
 import webapp2
+from google.appengine.ext import deferred
 from webapp2 import uri_for
 
+from cache import TwoTierCache, flights
 from common import common_request
-from model import CrashReport, GlobalPreferences, Link
+from model import CounterReconciler, CrashHistogram, CrashReport, GlobalPreferences, Link
 from search_model import Search
-from util import CrashReports
+from util import CrashReports, IngestQueue
 
 
 class RequestHandlerUtils(object):
@@ -40,6 +42,7 @@ class RootHandler(webapp2.RequestHandler):
         directory_links.append(Link('View Crash', uri_for('view_crash')))
         directory_links.append(Link('Update Crash Report', uri_for('update_crash_state')))
         directory_links.append(Link('Search', uri_for('search')))
+        directory_links.append(Link('Crashes by File', uri_for('frame_crashes')))
         directory_links.append(Link('Update Global Preferences', uri_for('update_global_preferences')))
         self.add_parameter('directory_links', directory_links)
         self.render('index.html')
@@ -74,14 +77,25 @@ class SubmitCrashHandler(webapp2.RequestHandler):
     @common_request
     def post(self):
         SubmitCrashHandler.common(self)
-        if self.empty_query_string('crash', 'labels'):
+        # strip spaces around the crash report (a crash that is only spaces has no fingerprint)
+        crash = (self.get_parameter('crash') or '').strip()
+        if not crash or self.empty_query_string('labels'):
             self.request_handler.redirect(uri_for('submit_crash'))
         else:
-            crash = self.get_parameter('crash')
             argv = SubmitCrashHandler.csv_to_list(self.get_parameter('argv'))
             labels = SubmitCrashHandler.csv_to_list(self.get_parameter('labels'))
-            # strip spaces around the crash report
-            crash_report = CrashReports.add_crash_report(crash.strip(), argv=argv, labels=labels)
+            if CrashReports.async_ingest():
+                fingerprint = CrashReports.enqueue_crash_reports([{
+                    'crash': crash,
+                    'argv': argv,
+                    'labels': labels
+                }])[0]
+                self.request_handler.response.set_status(202)
+                self.add_message('Queued Crash Report with fingerprint {0}'.format(fingerprint))
+                self.add_to_json('fingerprint', fingerprint)
+                self.render('submit-crash.html')
+                return
+            crash_report = CrashReports.add_crash_report(crash, argv=argv, labels=labels)
             message = 'Added Crash Report with fingerprint, count) => ({0}, {1})'.format(
                 crash_report.fingerprint, CrashReport.get_count(crash_report.name))
 
@@ -90,6 +104,82 @@ class SubmitCrashHandler(webapp2.RequestHandler):
             self.render('submit-crash.html')
 
 
+class SubmitCrashBatchHandler(webapp2.RequestHandler):
+
+    # maximum number of crash reports in a single batch
+    __MAX_BATCH_SIZE__ = 500
+
+    @classmethod
+    def parse_list(cls, name, value):
+        """
+        Parses a list of strings, that can either be a list or a csv string.
+        """
+        if value is None or isinstance(value, basestring):
+            return SubmitCrashHandler.csv_to_list(value)
+        if not isinstance(value, list) or not all(isinstance(item, basestring) for item in value):
+            raise ValueError('{0} must be a list of strings, or a csv string'.format(name))
+        return value
+
+    @classmethod
+    def parse_line(cls, line):
+        """
+        Parses a single NDJSON line into a crash report. argv and labels can either be lists or csv strings.
+        """
+        entry = json.loads(line)
+        if not isinstance(entry, dict):
+            raise ValueError('Expected a JSON object')
+        crash = entry.get('crash')
+        argv = entry.get('argv')
+        labels = entry.get('labels')
+        if crash is not None and not isinstance(crash, basestring):
+            raise ValueError('crash must be a string')
+        # strip spaces around the crash report (a crash that is only spaces has no fingerprint)
+        crash = crash.strip() if crash else crash
+        if not crash or not labels:
+            raise ValueError('Both crash and labels are required')
+        argv = SubmitCrashBatchHandler.parse_list('argv', argv)
+        labels = SubmitCrashBatchHandler.parse_list('labels', labels)
+        return {
+            'crash': crash,
+            'argv': argv,
+            'labels': labels
+        }
+
+    @common_request
+    def post(self):
+        SubmitCrashHandler.common(self)
+        results = list()
+        reports = list()
+        # line numbers refer to the lines of the request, blank lines included
+        for number, line in enumerate(self.request_handler.request.body.splitlines()):
+            if len(line.strip()) == 0:
+                continue
+            if len(results) >= SubmitCrashBatchHandler.__MAX_BATCH_SIZE__:
+                results.append({'line': number, 'error': 'Batch size exceeded'})
+                continue
+            try:
+                report = SubmitCrashBatchHandler.parse_line(line)
+                reports.append(report)
+                results.append({'line': number})
+            except ValueError, e:
+                results.append({'line': number, 'error': unicode(e)})
+
+        is_async = CrashReports.async_ingest()
+        if is_async:
+            fingerprints = CrashReports.enqueue_crash_reports(reports)
+            self.request_handler.response.set_status(202)
+        else:
+            fingerprints = CrashReports.add_crash_reports(reports)
+        accepted = [result for result in results if 'error' not in result]
+        for result, fingerprint in zip(accepted, fingerprints):
+            result['fingerprint'] = fingerprint
+
+        self.add_message('{0} {1} of {2} Crash Reports'.format(
+            'Queued' if is_async else 'Added', len(accepted), len(results)))
+        self.add_to_json('results', results)
+        self.render('submit-crash.html')
+
+
 class ViewCrashHandler(webapp2.RequestHandler):
     @classmethod
     def common(cls, handler):
@@ -112,6 +202,39 @@ class ViewCrashHandler(webapp2.RequestHandler):
         self.render('show-crash.html')
 
 
+class FrameCrashesHandler(webapp2.RequestHandler):
+    @classmethod
+    def common(cls, handler):
+        handler.add_parameter('title', 'Crashes by File')
+        handler.add_breadcrumb('Home', uri_for('home'))
+        handler.add_breadcrumb('Crashes by File', uri_for('frame_crashes'))
+        RequestHandlerUtils.add_brand(handler)
+        RequestHandlerUtils.add_nav_links(handler)
+
+    @common_request
+    def get(self):
+        FrameCrashesHandler.common(self)
+        if not self.empty_query_string('file'):
+            file_name = self.get_parameter('file')
+            cursor = self.get_parameter('cursor')
+            crashes = CrashReports.crashes_for_file(file_name, cursor=cursor)
+            results = crashes.get('results', list())
+            if results:
+                self.add_parameter('results', results)
+                self.add_to_json('results', results)
+
+            cursor = crashes.get('cursor', None)
+            if cursor:
+                query_fragment = {
+                    'file': file_name,
+                    'cursor': cursor
+                }
+                encoded_fragment = urllib.urlencode(query_fragment)
+                self.add_parameter('query_fragment', encoded_fragment)
+                self.add_to_json('query_fragment', encoded_fragment)
+        self.render('frames.html')
+
+
 class UpdateCrashStateHandler(webapp2.RequestHandler):
     @classmethod
     def common(cls, handler):
@@ -157,6 +280,7 @@ class TrendingCrashesHandler(webapp2.RequestHandler):
         trending_result = CrashReports.trending(start=start)
         self.add_parameter('trending', trending_result.get('trending', list()))
         self.add_parameter('has_more', trending_result.get('has_more', False))
+        self.add_parameter('next', trending_result.get('next'))
         self.add_to_json('trending', trending_result)
         self.render('trending.html')
 
@@ -206,9 +330,7 @@ class SearchCrashesHandler(webapp2.RequestHandler):
 class UpdatePreferencesHandler(webapp2.RequestHandler):
 
     # a list of all global prefences
-    __PREFERENCES__ = [
-        GlobalPreferences.__INTEGRATE_WITH_GITHUB__,
-    ]
+    __PREFERENCES__ = GlobalPreferences.__PREFERENCES__
 
     @classmethod
     def common(cls, handler):
@@ -224,14 +346,19 @@ class UpdatePreferencesHandler(webapp2.RequestHandler):
     @common_request
     def post(self):
         UpdatePreferencesHandler.common(self)
+        current = GlobalPreferences.get_properties()
         for preference in UpdatePreferencesHandler.__PREFERENCES__:
             if not self.empty_query_string(preference):
                 preference_value = self.get_parameter(preference)
+                if preference_value == current.get(preference):
+                    # unchanged
+                    continue
                 GlobalPreferences.update(preference, preference_value)
 
                 self.add_message('Updated %s to %s' % (preference, preference_value))
                 self.add_to_json('success', True)
 
+        self.add_parameter('preferences', GlobalPreferences.get_properties())
         self.render('update-global-preferences.html')
 
 
@@ -267,16 +394,91 @@ class GitHubWebHooksHandler(webapp2.RequestHandler):
                     logging.info('Other action {0}. Ignoring.'.format(action))
 
 
+class CrashHistogramHandler(webapp2.RequestHandler):
+    def get(self):
+        """
+        Returns the number of reports of a fingerprint per hour (or per day) as a compact JSON array.
+        """
+        fingerprint = self.request.get('fingerprint')
+        resolution = self.request.get('resolution', 'hour')
+        if not fingerprint:
+            self.abort(400, detail='fingerprint is required')
+        try:
+            buckets = int(self.request.get('buckets', '48' if resolution == 'hour' else '30'))
+            histogram = CrashHistogram.histogram(CrashReport.key_name(fingerprint), resolution, buckets)
+        except ValueError, e:
+            self.abort(400, detail=unicode(e))
+        histogram['fingerprint'] = fingerprint
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(json.dumps(histogram, separators=(',', ':')))
+
+
+class FlushCountersHandler(webapp2.RequestHandler):
+    def get(self):
+        """
+        Applies the buffered crash reports to the counter shards (called by cron).
+        """
+        flushed = CrashReports.flush_buffered_reports()
+        message = 'Flushed {0} buffered crash reports'.format(flushed)
+        logging.info(message)
+        self.response.out.write(message)
+
+
+class DrainIngestQueueHandler(webapp2.RequestHandler):
+    def get(self):
+        """
+        Adds the queued crash reports (called by cron), in case a scheduled drain failed.
+        """
+        drained = IngestQueue.drain()
+        message = 'Drained {0} queued crash reports'.format(drained)
+        logging.info(message)
+        self.response.out.write(message)
+
+
+class ReconcileCountersHandler(webapp2.RequestHandler):
+    def get(self):
+        """
+        Repairs drifted cached counts of recently active crashes (called by cron).
+        """
+        deferred.defer(CounterReconciler.reconcile)
+        message = 'Counter Reconciliation Started'
+        logging.info(message)
+        self.response.out.write(message)
+
+
+class StatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """
+        Exposes in-process cache statistics for this instance.
+        """
+        stats = {
+            'caches': dict((namespace, cache.stats()) for namespace, cache in TwoTierCache.instances.iteritems()),
+            'counter_reconciliation': CounterReconciler.stats(),
+            'coalesced_computations': flights.coalesced
+        }
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(json.dumps(stats, indent=2))
+
+
 application = webapp2.WSGIApplication(
     [
         webapp2.Route('/', handler='main.RootHandler', name='home'),
         webapp2.Route('/crashes/state/update', handler='main.UpdateCrashStateHandler', name='update_crash_state'),
         webapp2.Route('/crashes/submit', handler='main.SubmitCrashHandler', name='submit_crash'),
+        webapp2.Route('/crashes/submit/batch', handler='main.SubmitCrashBatchHandler', name='submit_crash_batch'),
         webapp2.Route('/crashes', handler='main.ViewCrashHandler', name='view_crash'),
+        webapp2.Route('/crashes/frames', handler='main.FrameCrashesHandler', name='frame_crashes'),
+        webapp2.Route('/crashes/histogram', handler='main.CrashHistogramHandler', name='crash_histogram'),
         webapp2.Route('/trending', handler='main.TrendingCrashesHandler', name='trending_crashes'),
         webapp2.Route('/search', handler='main.SearchCrashesHandler', name='search'),
         webapp2.Route('/preferences/update', handler='main.UpdatePreferencesHandler', name='update_global_preferences'),
         webapp2.Route('/webhooks/github', handler='main.GitHubWebHooksHandler', name='github_webhooks'),
+        webapp2.Route('/admin/stats', handler='main.StatsHandler', name='stats'),
+        webapp2.Route('/tasks/counters/flush', handler='main.FlushCountersHandler', name='flush_counters'),
+        webapp2.Route('/tasks/ingest/drain', handler='main.DrainIngestQueueHandler', name='drain_ingest_queue'),
+        webapp2.Route('/tasks/counters/reconcile', handler='main.ReconcileCountersHandler', name='reconcile_counters'),
+        webapp2.Route('/admin/fingerprints/migrate', handler='update_schema.MigrateFingerprintsHandler',
+                      name='migrate_fingerprints'),
     ]
     , debug=True
 )
@@ -1,8 +1,22 @@
 import datetime
+import hashlib
+import json
+import logging
+import Queue
+import math
 import random
+import sys
+import threading
+import time
 
 from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.ext import db
+from google.appengine.ext import deferred
+
+from cache import StaleWhileRevalidate, TwoTierCache, flights, memoize_multi
+from frames import deserialize_frames, frame_files as files_for_frames, serialize_frames
+from simhash import __NEAR_DUPLICATE_DISTANCE__, hamming_distance, parse_fingerprint, permuted_blocks
 
 
 def from_milliseconds(millis):
@@ -14,10 +28,78 @@ def to_milliseconds(date_time):
     return int(round(delta.total_seconds() * 1000))
 
 
+def defer_async(function, *args, **kwargs):
+    """
+    Like deferred.defer, but only starts adding the task, and returns the RPC.
+    Accepts the same task options (_countdown, _name and _queue).
+    """
+    options = dict((option[1:], kwargs.pop(option)) for option in ('_countdown', '_name') if option in kwargs)
+    queue = kwargs.pop('_queue', 'default')
+    task = taskqueue.Task(payload=deferred.serialize(function, *args, **kwargs), url='/_ah/queue/deferred',
+                          headers={'Content-Type': 'application/octet-stream'}, **options)
+    return taskqueue.Queue(queue).add_async(task)
+
+
+def run_in_parallel(function, arguments, max_threads=8):
+    """
+    Calls function(*args) for every tuple of args in arguments, on up to max_threads threads, and returns the
+    results in the same order. Datastore transactions are bound to a thread, so short independent transactions
+    can run side by side. The first exception raised by a call is re-raised once all the calls are done.
+    """
+    arguments = list(arguments)
+    if len(arguments) <= 1:
+        return [function(*args) for args in arguments]
+    results = [None] * len(arguments)
+    errors = list()
+    pending = Queue.Queue()
+    for index in range(len(arguments)):
+        pending.put(index)
+
+    def worker():
+        while True:
+            try:
+                index = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = function(*arguments[index])
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker) for i in range(min(max_threads, len(arguments)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        error_type, error, traceback = errors[0]
+        raise error_type, error, traceback
+    return results
+
+
+def wait_all(rpcs):
+    """
+    Waits for the RPCs of tasks added with defer_async. Tasks that could not be added are logged.
+    """
+    for rpc in rpcs:
+        try:
+            rpc.get_result()
+        except taskqueue.Error, e:
+            logging.warning('Unable to add task (%s)', e)
+
+
 class GlobalPreferences(db.Expando):
 
     # github integration preference
     __INTEGRATE_WITH_GITHUB__ = 'integrate_with_github'
+    # comma separated list of trace normalization rules
+    __NORMALIZATION_RULES__ = 'normalization_rules'
+    # fingerprint the top N in-app frames instead of the whole trace (0 turns this off)
+    __FINGERPRINT_FRAMES__ = 'fingerprint_frames'
+    # buffer the reports of known crashes, and apply them to the counter shards periodically
+    __WRITE_BEHIND_COUNTERS__ = 'write_behind_counters'
+    # queue crash submissions, and add them in the background
+    __ASYNC_INGEST__ = 'async_ingest'
 
     """
     Global preferences that can control the behavior of the crash reporter.
@@ -25,12 +107,43 @@ class GlobalPreferences(db.Expando):
     property_name = db.StringProperty()
     property_value = db.StringProperty()
 
+    # a list of all global preferences
+    __PREFERENCES__ = [
+        __INTEGRATE_WITH_GITHUB__,
+        __NORMALIZATION_RULES__,
+        __FINGERPRINT_FRAMES__,
+        __WRITE_BEHIND_COUNTERS__,
+        __ASYNC_INGEST__,
+    ]
+
+    # preferences are read on every submission, and change rarely. Every instance keeps all of them in-process,
+    # and an update bumps the generation of the namespace (which instances check every 10 seconds).
+    cache = TwoTierCache('preferences', capacity=16, local_ttl=300, ttl=86400, generation_ttl=10)
+
     @classmethod
     def key_name(cls, property_name):
         return cls.kind() + '_' + property_name
 
+    @classmethod
+    def get_properties(cls):
+        """
+        Returns a dict of property name -> value for all the preferences that are set.
+        All the preferences are loaded with a single batch get.
+        """
+        properties = GlobalPreferences.cache.get('all')
+        if properties is None:
+            names = GlobalPreferences.__PREFERENCES__
+            preferences = GlobalPreferences.get_by_key_name([GlobalPreferences.key_name(name) for name in names])
+            properties = dict((name, preference.property_value)
+                              for name, preference in zip(names, preferences) if preference is not None)
+            GlobalPreferences.cache.set('all', properties)
+        return properties
+
     @classmethod
     def get_property(cls, property_name, default_value=None):
+        if property_name in GlobalPreferences.__PREFERENCES__:
+            value = GlobalPreferences.get_properties().get(property_name)
+            return default_value if value is None else value
         key_name = GlobalPreferences.key_name(property_name)
         preference = GlobalPreferences.get_by_key_name(key_names=key_name)
         if preference is None:
@@ -45,6 +158,8 @@ class GlobalPreferences(db.Expando):
         preference.property_value = property_value
         # update
         db.put(preference)
+        # every instance reloads the preferences
+        GlobalPreferences.cache.invalidate()
         return preference
 
 
@@ -56,19 +171,172 @@ class ShardedCounterConfig(db.Expando):
     name = db.StringProperty(required=True)
     shards = db.IntegerProperty(default=1)
 
+    # counters start with a single shard, and double (up to this limit) when they get hot
+    __MAX_SHARDS__ = 64
+    # a shard can sustain roughly one write per second
+    __WRITES_PER_SHARD_PER_MINUTE__ = 60
+    # shard counts cached in-process are only used to pick a shard to write to
+    cache = TwoTierCache('shard_count', capacity=4096, local_ttl=60, ttl=86400)
+
     @classmethod
-    def cache_key(cls, name):
-        return 'shard_config_' + name
+    def rate_cache_key(cls, name, minute):
+        return 'shard_writes_{0}_{1}'.format(name, minute)
 
     @classmethod
-    def get_sharded_config(cls, name):
-        cache_key = ShardedCounterConfig.cache_key(name)
-        config = memcache.get(cache_key)
-        if not config:
+    def get_shard_count(cls, name, local=False):
+        """
+        Returns the number of shards of a counter. Shards only ever grow, so the shards are always name_0 ... name_n-1.
+        Readers must see every shard, and use the shared (memcache) value. Writers can use a slightly stale
+        in-process value (local=True), that only narrows the choice of shards.
+        """
+        shards = ShardedCounterConfig.cache.get(name, local=local)
+        if shards is None:
             ''' Try fetching from datastore '''
-            config = ShardedCounterConfig.get_or_insert(name, name=name, shards=20)
-            memcache.set(cache_key, config, time=86400)
-        return config
+            config = ShardedCounterConfig.get_or_insert(name, name=name, shards=1)
+            shards = config.shards
+            ShardedCounterConfig.cache.set(name, shards)
+        return int(shards)
+
+    @classmethod
+    def grow(cls, name, shards=None):
+        """
+        Doubles the number of shards of a counter. shards is the shard count the caller saw, so that concurrent
+        callers that saw the same count only grow the counter once.
+        """
+        def txn():
+            config = ShardedCounterConfig.get_by_key_name(name)
+            if config is None:
+                config = ShardedCounterConfig(key_name=name, name=name, shards=1)
+            if shards is not None and config.shards > shards:
+                # already grown
+                return config.shards
+            if config.shards >= ShardedCounterConfig.__MAX_SHARDS__:
+                return config.shards
+            config.shards = min(config.shards * 2, ShardedCounterConfig.__MAX_SHARDS__)
+            config.put()
+            return config.shards
+
+        new_shards = db.run_in_transaction(txn)
+        logging.info('Counter %s now has %s shards', name, new_shards)
+        ShardedCounterConfig.cache.set(name, new_shards)
+        return new_shards
+
+    @classmethod
+    def rate_offsets(cls, writes, minute):
+        """
+        The memcache offsets that track the write rate of counters.
+        writes is a dict of name -> (shard count used, number of writes).
+        """
+        return dict((ShardedCounterConfig.rate_cache_key(name, minute), count)
+                    for name, (shards, count) in writes.iteritems())
+
+    @classmethod
+    def grow_hot(cls, writes, rates, minute):
+        """
+        Grows the counters whose write rates (the result of incrementing rate_offsets) are too high.
+        """
+        for name, (shards, count) in writes.iteritems():
+            rate = rates.get(ShardedCounterConfig.rate_cache_key(name, minute))
+            if rate is not None and rate > shards * ShardedCounterConfig.__WRITES_PER_SHARD_PER_MINUTE__ \
+                    and shards < ShardedCounterConfig.__MAX_SHARDS__:
+                ShardedCounterConfig.grow(name, shards)
+
+
+class FingerprintBucket(db.Model):
+    """
+    A bucket in the permuted-prefix table used to look up near duplicate fingerprints.
+    Every fingerprint is split into blocks, and is registered in one bucket per block.
+    __key__ == <number of blocks>_<block index>_<block value>
+    """
+    fingerprints = db.StringListProperty(indexed=False)
+
+    # fingerprint -> resolved fingerprint. Buckets only ever grow, so a resolution is stable once registered.
+    cache = TwoTierCache('resolved_fingerprint', capacity=4096, local_ttl=None, ttl=86400)
+
+    @classmethod
+    def bucket_key_names(cls, fingerprint, max_distance=__NEAR_DUPLICATE_DISTANCE__):
+        value = parse_fingerprint(fingerprint)
+        if value is None:
+            return list()
+        blocks = permuted_blocks(value, max_distance=max_distance)
+        return ['{0}_{1}_{2:x}'.format(len(blocks), index, block) for index, block in blocks]
+
+    @classmethod
+    def resolve(cls, fingerprints, max_distance=__NEAR_DUPLICATE_DISTANCE__, register=True):
+        """
+        Maps every fingerprint to the closest known fingerprint within max_distance bits.
+        Fingerprints without a near duplicate are registered as new fingerprints (unless register is False).
+        Resolutions are memoized, and the buckets of the others are probed with a single batch get.
+        """
+        # only resolutions with the default distance are memoized
+        memoize = max_distance == __NEAR_DUPLICATE_DISTANCE__
+        memoized = FingerprintBucket.cache.get_multi(set(fingerprints) - {None}) if memoize else dict()
+        if all(fingerprint in memoized for fingerprint in fingerprints):
+            return [memoized.get(fingerprint) for fingerprint in fingerprints]
+
+        key_names = set()
+        for fingerprint in fingerprints:
+            if fingerprint not in memoized:
+                key_names.update(FingerprintBucket.bucket_key_names(fingerprint, max_distance))
+        key_names = list(key_names)
+
+        known = dict()
+        if key_names:
+            for key_name, bucket in zip(key_names, FingerprintBucket.get_by_key_name(key_names)):
+                if bucket is not None:
+                    known[key_name] = list(bucket.fingerprints)
+
+        resolved = list()
+        to_register = dict()
+        for fingerprint in fingerprints:
+            if fingerprint in memoized:
+                resolved.append(memoized.get(fingerprint))
+                continue
+            value = parse_fingerprint(fingerprint)
+            if value is None:
+                # not a SimHash fingerprint
+                resolved.append(fingerprint)
+                continue
+
+            closest = None
+            closest_distance = None
+            bucket_key_names = FingerprintBucket.bucket_key_names(fingerprint, max_distance)
+            for key_name in bucket_key_names:
+                for candidate in known.get(key_name, list()):
+                    distance = hamming_distance(value, parse_fingerprint(candidate))
+                    if distance <= max_distance and \
+                            (closest is None or (distance, candidate) < (closest_distance, closest)):
+                        closest = candidate
+                        closest_distance = distance
+
+            if closest is None:
+                closest = fingerprint
+                for key_name in bucket_key_names:
+                    known.setdefault(key_name, list()).append(fingerprint)
+                    to_register.setdefault(key_name, list()).append(fingerprint)
+            resolved.append(closest)
+
+        if register:
+            FingerprintBucket.register(to_register)
+            if memoize:
+                FingerprintBucket.cache.set_multi(dict(
+                    (fingerprint, closest) for fingerprint, closest in zip(fingerprints, resolved)
+                    if fingerprint is not None and fingerprint not in memoized))
+        return resolved
+
+    @classmethod
+    def register(cls, fingerprints_by_bucket):
+        def txn(key_name, fingerprints):
+            bucket = FingerprintBucket.get_by_key_name(key_name)
+            if bucket is None:
+                bucket = FingerprintBucket(key_name=key_name)
+            missing = [fingerprint for fingerprint in fingerprints if fingerprint not in bucket.fingerprints]
+            if missing:
+                bucket.fingerprints.extend(missing)
+                bucket.put()
+
+        for key_name, fingerprints in fingerprints_by_bucket.iteritems():
+            db.run_in_transaction(txn, key_name, fingerprints)
 
 
 class CrashReport(db.Expando):
@@ -89,117 +357,439 @@ class CrashReport(db.Expando):
     argv = db.StringListProperty(default=[])
     # reflects the schema version
     version = db.StringProperty(default='2')
+    # the fingerprint before the crash report was rekeyed
+    legacy_fingerprint = db.StringProperty(required=False)
+    # the version of the normalization rules used to compute the fingerprint
+    normalization = db.StringProperty(required=False)
+    # parsed stack frames ('function\tfile')
+    frames = db.StringListProperty(default=[], indexed=False)
+    # files touched by the stack frames (indexed, to look up crashes by file)
+    frame_files = db.StringListProperty(default=[])
+
+    # number of shards an increment is attempted on, before giving up
+    __SHARD_ATTEMPTS__ = 3
+    # retries on the same shard, before moving to a different shard
+    __SHARD_TRANSACTION_RETRIES__ = 1
+
+    # totals are kept current by increments, and recomputed from the shards every 5 minutes
+    count_cache = StaleWhileRevalidate(soft_ttl=300)
+
+    @classmethod
+    def shard_keys(cls, name):
+        """
+        Shard key names are deterministic (name_0 ... name_n-1), so we never need a query to find them.
+        """
+        shards = ShardedCounterConfig.get_shard_count(name)
+        return [db.Key.from_path(cls.kind(), name + '_' + str(shard)) for shard in range(shards)]
+
+    @classmethod
+    def get_shards(cls, name):
+        """
+        Fetches all existing shards with a single (strongly consistent) batch get.
+        """
+        return [shard for shard in db.get(CrashReport.shard_keys(name)) if shard is not None]
 
     @classmethod
     def get_count(cls, name):
-        cache_key = CrashReport.count_cache_key(name)
-        total = memcache.get(cache_key)
-        if total is None:
-            total = 0
-            q = CrashReport.all()
-            q.filter('name = ', name)
-            for entity in q.run():
-                total += entity.count
-            memcache.set(cache_key, str(total))
-        return int(total)
-
-    @classmethod
-    def clear_properties_cache(cls, name):
-        keys = list()
-        keys.extend(
-            CrashReport.recent_crash_property_key(name, key) for key in
-            ['date_time', 'state', 'labels', 'issue', 'argv']
-        )
-        memcache.delete_multi(keys=keys)
-
-    @classmethod
-    def _most_recent_property(
-            cls, name, property_name, default_value=None, serialize=lambda x: x, deserialize=lambda x: x, ttl=120):
-
-        cache_key = CrashReport.recent_crash_property_key(name, property_name)
-        most_recent_value = memcache.get(cache_key)
-        if most_recent_value is None:
-            most_recent = 0
-            most_recent_value = default_value
-
-            q = CrashReport.all()
-            q.filter('name = ', name)
-            for entity in q.run():
-                in_millis = to_milliseconds(entity.date_time)
-                if most_recent <= in_millis:
-                    most_recent = in_millis
-                    most_recent_value = serialize(entity.__getattribute__(property_name))
-            memcache.set(cache_key, most_recent_value, ttl)
-        to_return = deserialize(most_recent_value)
-        return to_return
+        """
+        Only one request recomputes an expired or evicted total from the shards. While it does, the others are
+        served the cached total, or the count of the summary.
+        """
+        total = CrashReport.count_cache.get(
+            CrashReport.count_cache_key(name),
+            lambda: str(sum(entity.count for entity in CrashReport.get_shards(name))),
+            fallback=lambda: CrashReport.get_summary(name).get('count'))
+        # include the reports that have not been flushed yet
+        return int(total) + int(memcache.get(CounterBuffer.pending_cache_key(name)) or 0)
+
+    @classmethod
+    def get_counts(cls, names, summaries=None):
+        """
+        Returns a dict of name -> total count, from the cached totals and the buffered reports (with a single
+        get_multi). Totals that are not cached fall back to the count of the summary (summaries can be passed in).
+        """
+        cache_keys = dict((CrashReport.count_cache_key(name), name) for name in names)
+        pending_keys = dict((CounterBuffer.pending_cache_key(name), name) for name in names)
+        cached = memcache.get_multi(cache_keys.keys() + pending_keys.keys()) if cache_keys else dict()
+        counts = dict((cache_keys.get(cache_key), int(cached.get(cache_key)))
+                      for cache_key in cache_keys.keys() if cache_key in cached)
+        missing = [name for name in names if name not in counts]
+        if missing:
+            summaries = summaries if summaries is not None else CrashReport.get_summaries(missing)
+            for name in missing:
+                counts[name] = (summaries.get(name) or dict()).get('count', 0)
+        # include the reports that have not been flushed yet
+        for pending_key, name in pending_keys.iteritems():
+            counts[name] += int(cached.get(pending_key) or 0)
+        return counts
+
+    @classmethod
+    def compute_summary(cls, name):
+        """
+        Walks the shards of a fingerprint once, and derives the total count and every "most recent" property.
+        """
+        summary = CrashSummary.to_dict(None)
+        most_recent = 0
+        for entity in CrashReport.get_shards(name):
+            summary['count'] += entity.count
+            summary['fingerprint'] = entity.fingerprint
+            in_millis = to_milliseconds(entity.date_time)
+            if summary['first_seen'] is None or in_millis < summary['first_seen']:
+                summary['first_seen'] = in_millis
+                summary['snippet'] = CrashSummary.snippet(entity.crash)
+            if most_recent <= in_millis:
+                most_recent = in_millis
+                summary['time'] = in_millis
+                summary['state'] = entity.state
+                summary['labels'] = entity.labels
+                summary['issue'] = entity.issue
+                summary['argv'] = entity.argv
+        return summary
+
+    @classmethod
+    def get_summary(cls, name, ttl=None):
+        """
+        The fingerprint summary (total count, and the most recent properties), cached as a single value.
+        Backed by the CrashSummary entity, so a memcache miss is a single get.
+        """
+        return CrashReport.get_summaries([name], ttl=ttl).get(name)
+
+    @classmethod
+    def get_summaries(cls, names, ttl=None):
+        """
+        Fetches the summaries for many fingerprints, with one memcache get_multi and one batch get.
+        Returns a dict of name -> summary.
+        """
+        ttl = ttl or CrashSummary.__CACHE_TTL__
+        cache_keys = dict((CrashReport.summary_cache_key(name), name) for name in names)
+        cached = memcache.get_multi(cache_keys.keys()) if cache_keys else dict()
+        summaries = dict((cache_keys.get(cache_key), summary) for cache_key, summary in cached.iteritems())
+        missing = [name for name in names if name not in summaries]
+        if missing:
+            to_cache = dict()
+            for name, entity in zip(missing, CrashSummary.get_by_key_name(missing)):
+                if entity is None:
+                    # not materialized yet (concurrent rebuilds in this instance are coalesced)
+                    entity = flights.do('rebuild_summary_' + name, CrashSummary.rebuild, name)
+                summary = CrashSummary.to_dict(entity)
+                summaries[name] = summary
+                to_cache[CrashReport.summary_cache_key(name)] = summary
+            # do not clobber a newer summary written through by a concurrent update
+            memcache.add_multi(to_cache, time=ttl)
+        return summaries
 
     @classmethod
     def most_recent_crash(cls, name):
-        return CrashReport._most_recent_property(
-            name, 'date_time', serialize=lambda x: str(to_milliseconds(x)), deserialize=lambda x: int(x))
+        return CrashReport.get_summary(name).get('time')
 
     @classmethod
     def most_recent_labels(cls, name):
-        return CrashReport._most_recent_property(
-            name, 'labels',
-            default_value=list(),
-            serialize=lambda x: ','.join(x),
-            deserialize=lambda x: x.split(','))
+        return CrashReport.get_summary(name).get('labels')
 
     @classmethod
     def most_recent_state(cls, name):
-        return CrashReport._most_recent_property(name, 'state', default_value='unresolved')
+        return CrashReport.get_summary(name).get('state')
 
     @classmethod
     def most_recent_issue(cls, name):
-        return CrashReport._most_recent_property(name, 'issue')
+        return CrashReport.get_summary(name).get('issue')
 
     @classmethod
     def most_recent_argv(cls, name):
-        return CrashReport._most_recent_property(name, 'argv', default_value=list())
+        return CrashReport.get_summary(name).get('argv')
+
+    @classmethod
+    def increment_shard(cls, key_name, delta, shards, **properties):
+        """
+        Adds delta to a random shard of a counter, in a short transaction. When the shard is contended, the counter
+        grows, and the increment is retried on a different shard (up to __SHARD_ATTEMPTS__ shards).
+        properties are used to create the shard, if it does not exist yet.
+        Returns a tuple of (shard, whether the shard is new, number of shards).
+        """
+        def txn(shard_key_name):
+            crash_report = CrashReport.get_by_key_name(shard_key_name)
+            if crash_report is None:
+                crash_report = CrashReport(key_name=shard_key_name, name=key_name, **properties)
+            # a new shard becomes the most recent shard
+            new_shard = crash_report.count == 0
+            crash_report.count += delta
+            crash_report.put()
+            return crash_report, new_shard
+
+        tried = set()
+        options = db.create_transaction_options(retries=CrashReport.__SHARD_TRANSACTION_RETRIES__)
+        while True:
+            candidates = [shard for shard in range(shards) if shard not in tried] or range(shards)
+            shard_to_use = random.choice(candidates)
+            tried.add(shard_to_use)
+            try:
+                crash_report, new_shard = db.run_in_transaction_options(
+                    options, txn, key_name + '_' + str(shard_to_use))
+                return crash_report, new_shard, shards
+            except db.TransactionFailedError:
+                if len(tried) >= CrashReport.__SHARD_ATTEMPTS__:
+                    raise
+                # the shard is contended, spread writes over more shards and retry on a different shard
+                logging.info('Shard %s_%s is contended, retrying on a different shard', key_name, shard_to_use)
+                shards = ShardedCounterConfig.grow(key_name, shards)
 
     @classmethod
-    def add_or_remove(cls, fingerprint, crash, argv=None, labels=None, is_add=True, delta=1):
+    def add_or_remove(
+            cls, fingerprint, crash, argv=None, labels=None, is_add=True, delta=1, normalization=None, frames=None):
         # use an issue if one already exists
         issue = CrashReport.most_recent_issue(CrashReport.key_name(fingerprint))
         key_name = CrashReport.key_name(fingerprint)
-        config = ShardedCounterConfig.get_sharded_config(key_name)
-        shards = config.shards
-        shard_to_use = random.randint(0, shards-1)
-        shard_key_name = key_name + '_' + str(shard_to_use)
+        shards = ShardedCounterConfig.get_shard_count(key_name, local=True)
         if not argv:
             argv = []
-        crash_report = CrashReport \
-            .get_or_insert(shard_key_name,
-                           name=key_name,
-                           crash=crash,
-                           fingerprint=fingerprint,
-                           argv=argv,
-                           labels=labels,
-                           issue=issue)
-        if is_add:
-            crash_report.count += delta
-            crash_report.put()
-            # update caches
-            memcache.incr(CrashReport.count_cache_key(key_name), delta, initial_value=0)
-        else:
-            crash_report.count -= delta
-            crash_report.put()
-            memcache.decr(CrashReport.count_cache_key(key_name), delta)
 
-        # clear properties cache
-        CrashReport.clear_properties_cache(key_name)
+        crash_report, new_shard, shards = CrashReport.increment_shard(
+            key_name, delta if is_add else -delta, shards,
+            crash=crash,
+            fingerprint=fingerprint,
+            argv=argv,
+            labels=labels,
+            issue=issue,
+            normalization=normalization,
+            **CrashReport.frame_properties(frames))
+
+        if new_shard:
+            # the fingerprint might have been cached as unknown
+            CrashReport.crash_keys.invalidate([fingerprint])
+        CrashReport.record_increments(
+            {key_name: delta if is_add else -delta},
+            writes={key_name: (shards, 1)} if is_add else None,
+            new_shards=[{
+                'name': key_name,
+                'argv': argv,
+                'labels': labels,
+                'state': crash_report.state
+            }] if new_shard else None)
         return crash_report
 
+    @classmethod
+    def record_increments(cls, deltas, writes=None, new_shards=None):
+        """
+        Propagates shard increments (a dict of name -> delta) to the cached totals, the write rates,
+        the histograms and the summaries. The independent memcache RPCs run concurrently, and are only waited on
+        at the end. Summaries are not written on every report: reports are buffered in memcache, and rolled up
+        by a deferred task (see CrashSummary.rollup). Only new shards (which are rare) update the summary right away.
+        new_shards is a list of dicts with the 'name', 'argv', 'labels' and 'state' of the new shards.
+        """
+        client = memcache.Client()
+        now = time.time()
+        minute = int(now) // 60
+        # an evicted total is recomputed from the shards on the next read, so there is no initial value
+        count_rpc = client.offset_multi_async(
+            dict((CrashReport.count_cache_key(name), delta) for name, delta in deltas.iteritems()))
+        reports = dict((name, delta) for name, delta in deltas.iteritems() if delta > 0)
+        offsets = CrashHistogram.offsets(reports, timestamp=now)
+        offsets.update(CrashSummary.offsets(reports))
+        offsets.update(ShardedCounterConfig.rate_offsets(writes or dict(), minute))
+        offsets_rpc = client.offset_multi_async(offsets, initial_value=0) if offsets else None
+
+        updated = list()
+        failed = list()
+        for shard in new_shards or list():
+            entity = CrashSummary.record(
+                shard.get('name'), argv=shard.get('argv'), labels=shard.get('labels'), state=shard.get('state'))
+            if entity is not None:
+                updated.append(entity)
+            else:
+                failed.append(shard.get('name'))
+        CrashSummary.write_through(updated)
+        if failed:
+            # a rebuild is scheduled
+            client.delete_multi([CrashReport.summary_cache_key(name) for name in failed])
+
+        task_rpcs = list()
+        # removals are not buffered, the count of the summary is synced with the shards by the next rollup
+        for name in [name for name, delta in deltas.iteritems() if delta <= 0]:
+            task_rpcs.append(CrashSummary.rollup_later(name))
+        if offsets_rpc is not None:
+            results = offsets_rpc.get_result() or dict()
+            ShardedCounterConfig.grow_hot(writes or dict(), results, minute)
+            for name, delta in reports.iteritems():
+                # only the report that finds a buffer empty schedules a rollup
+                if results.get(CrashSummary.delta_cache_key(name)) == delta:
+                    task_rpcs.append(CrashSummary.rollup_later(name))
+                if CrashHistogram.should_rollup(name, delta, results, timestamp=now):
+                    task_rpcs.append(CrashHistogram.rollup_later(name))
+        count_rpc.get_result()
+        wait_all(task_rpcs)
+
+    @classmethod
+    def add_batch(cls, aggregates, normalization=None):
+        """
+        Applies aggregated deltas for many fingerprints at once.
+        aggregates is a dict of fingerprint -> {'crash', 'argv', 'labels', 'frames', 'delta'}.
+        Every fingerprint gets exactly one shard increment, in its own short transaction, and the transactions
+        run concurrently. The deltas that could not be applied (the shards kept being contended) are retried
+        by a deferred task, so the deltas that were applied are never applied twice.
+        Returns the list of crash reports (shards) that were updated.
+        """
+        if not aggregates:
+            return list()
+
+        def increment(fingerprint):
+            aggregate = aggregates.get(fingerprint)
+            key_name = CrashReport.key_name(fingerprint)
+            shards = ShardedCounterConfig.get_shard_count(key_name, local=True)
+            try:
+                return CrashReport.increment_shard(
+                    key_name, aggregate.get('delta', 1), shards,
+                    crash=aggregate.get('crash'),
+                    fingerprint=fingerprint,
+                    argv=aggregate.get('argv') or [],
+                    labels=aggregate.get('labels'),
+                    issue=CrashReport.most_recent_issue(key_name),
+                    normalization=normalization,
+                    **CrashReport.frame_properties(aggregate.get('frames')))
+            except (db.TransactionFailedError, db.Timeout):
+                logging.warning('Unable to increment %s. Retrying later.', key_name)
+                return None
+
+        fingerprints = aggregates.keys()
+        results = run_in_parallel(increment, [(fingerprint,) for fingerprint in fingerprints])
+        failed = dict((fingerprint, aggregates.get(fingerprint))
+                      for fingerprint, result in zip(fingerprints, results) if result is None)
+        if failed:
+            deferred.defer(CrashReport.add_batch, failed, normalization=normalization, _countdown=10)
+
+        crash_reports = list()
+        deltas = dict()
+        writes = dict()
+        new_shards = list()
+        new_fingerprints = list()
+        for fingerprint, result in zip(fingerprints, results):
+            if result is None:
+                continue
+            crash_report, new_shard, shards = result
+            aggregate = aggregates.get(fingerprint)
+            crash_reports.append(crash_report)
+            deltas[crash_report.name] = aggregate.get('delta', 1)
+            writes[crash_report.name] = (shards, 1)
+            if new_shard:
+                new_fingerprints.append(fingerprint)
+                new_shards.append({
+                    'name': crash_report.name,
+                    'argv': aggregate.get('argv') or [],
+                    'labels': aggregate.get('labels'),
+                    'state': crash_report.state
+                })
+
+        # the new fingerprints might have been cached as unknown
+        CrashReport.crash_keys.invalidate(new_fingerprints)
+        CrashReport.record_increments(deltas, writes=writes, new_shards=new_shards)
+        return crash_reports
+
+    @classmethod
+    def rekey(cls, crash_report, fingerprint, normalization=None):
+        """
+        Moves a crash report shard to a new fingerprint without losing its count.
+        The old shard is deleted, and its count is added to the corresponding shard of the new fingerprint.
+        """
+        key_name = CrashReport.key_name(fingerprint)
+        shards = ShardedCounterConfig.get_shard_count(key_name)
+        shard_to_use = int(crash_report.key().name().rsplit('_', 1)[-1]) % shards
+        shard_key_name = key_name + '_' + str(shard_to_use)
+
+        if shard_key_name == crash_report.key().name():
+            raise ValueError(
+                'Crash report {0} already has fingerprint {1}'.format(crash_report.key().name(), fingerprint))
+
+        def txn():
+            source = CrashReport.get(crash_report.key())
+            if source is None:
+                # already moved
+                return None
+            target = CrashReport.get_by_key_name(shard_key_name)
+            if target is None:
+                target = CrashReport(
+                    key_name=shard_key_name,
+                    name=key_name,
+                    crash=source.crash,
+                    fingerprint=fingerprint,
+                    argv=source.argv,
+                    labels=source.labels,
+                    date_time=source.date_time,
+                    state=source.state,
+                    issue=source.issue,
+                    frames=source.frames,
+                    frame_files=source.frame_files,
+                    legacy_fingerprint=source.fingerprint)
+            target.normalization = normalization
+            target.count += source.count
+            if source.date_time > target.date_time:
+                target.date_time = source.date_time
+            db.delete(source)
+            db.put(target)
+            return target
+
+        xg_on = db.create_transaction_options(xg=True)
+        moved = db.run_in_transaction_options(xg_on, txn)
+        CrashReport.crash_keys.invalidate([crash_report.fingerprint, fingerprint])
+        CrashSummary.rebuild(crash_report.name)
+        CrashSummary.rebuild(key_name)
+        # both fingerprints have changed (the summaries are written through by rebuild)
+        memcache.delete_multi([CrashReport.count_cache_key(crash_report.name), CrashReport.count_cache_key(key_name)])
+        return moved
+
+    @classmethod
+    def frame_properties(cls, frames):
+        """
+        The (serialized) frame properties for a list of (function, file) frames.
+        """
+        if not frames:
+            return {'frames': [], 'frame_files': []}
+        return {
+            'frames': serialize_frames(frames),
+            'frame_files': files_for_frames(frames)
+        }
+
+    @classmethod
+    @memoize_multi('crash_keys', ttl=86400)
+    def crash_keys(cls, fingerprints):
+        """
+        Finds a shard for every fingerprint. Returns a dict of fingerprint -> shard key.
+        """
+        keys = dict()
+        for fingerprint in fingerprints:
+            q = CrashReport.all(keys_only=True)
+            q.filter('name =', CrashReport.key_name(fingerprint))
+            key = q.get()
+            if not key:
+                # the crash report might have been rekeyed
+                q = CrashReport.all(keys_only=True)
+                q.filter('legacy_fingerprint =', fingerprint)
+                key = q.get()
+            if key:
+                keys[fingerprint] = unicode(key)
+        return keys
+
+    @classmethod
+    def get_crashes(cls, fingerprints, retry=True):
+        """
+        Returns a dict of fingerprint -> crash report (a shard of the fingerprint).
+        """
+        keys = CrashReport.crash_keys(fingerprints)
+        found = [fingerprint for fingerprint in fingerprints if keys.get(fingerprint)]
+        crash_reports = dict()
+        stale = list()
+        for fingerprint, crash_report in zip(found, db.get([keys.get(fingerprint) for fingerprint in found])):
+            if crash_report is None:
+                # the shard was moved or deleted since
+                stale.append(fingerprint)
+            else:
+                crash_reports[fingerprint] = crash_report
+        if stale and retry:
+            CrashReport.crash_keys.invalidate(stale)
+            crash_reports.update(CrashReport.get_crashes(stale, retry=False))
+        return crash_reports
+
     @classmethod
     def get_crash(cls, fingerprint):
-        q = CrashReport.all()
-        q.filter('name =', CrashReport.key_name(fingerprint))
-        crash_report = q.get()
-        if not crash_report:
-            return None
-        else:
-            return crash_report
+        return CrashReport.get_crashes([fingerprint]).get(fingerprint)
 
     @classmethod
     def key_name(cls, name):
@@ -210,21 +800,719 @@ class CrashReport(db.Expando):
         return 'total_{0}'.format(name)
 
     @classmethod
-    def recent_crash_property_key(cls, name, property_name):
-        return 'most_recent_{0}/{1}'.format(name, property_name)
+    def summary_cache_key(cls, name):
+        return 'summary_{0}'.format(name)
 
     @classmethod
     def to_json(cls, entity):
+        summary = CrashReport.get_summary(entity.name)
         return {
             'key': unicode(entity.key()),
             'crash': entity.crash,
-            'argv': CrashReport.most_recent_argv(entity.name),
-            'labels': CrashReport.most_recent_labels(entity.name),
+            'argv': summary.get('argv'),
+            'labels': summary.get('labels'),
             'fingerprint': entity.fingerprint,
-            'time': CrashReport.most_recent_crash(entity.name),  # in millis
+            'frames': [{'function': function, 'file': file_name}
+                       for function, file_name in deserialize_frames(entity.frames)],
+            'time': summary.get('time'),  # in millis
             'count': CrashReport.get_count(entity.name),
-            'state': CrashReport.most_recent_state(entity.name),
-            'issue': CrashReport.most_recent_issue(entity.name)
+            'state': summary.get('state'),
+            'issue': summary.get('issue')
+        }
+
+
+class CounterBuffer(object):
+    """
+    Write-behind buffer for the counters of hot crashes.
+    Reports are appended to a pull queue (which is durable), and counted in memcache so they show up in counts
+    right away. A periodic flush leases the queued reports, and applies them with a single batch of shard writes,
+    so the number of datastore writes scales with the flush frequency instead of the report rate.
+    When memcache evicts a pending count, only the displayed count lags until the next flush.
+    """
+    __QUEUE_NAME__ = 'counter-queue'
+    # maximum number of reports leased by a single flush
+    __LEASE_SIZE__ = 1000
+    __LEASE_SECONDS__ = 300
+
+    @classmethod
+    def pending_cache_key(cls, name):
+        return 'pending_count_' + name
+
+    @classmethod
+    def add(cls, fingerprint, crash, argv=None, labels=None, normalization=None, frames=None):
+        """
+        Buffers a single report of a fingerprint.
+        """
+        name = CrashReport.key_name(fingerprint)
+        payload = json.dumps({
+            'fingerprint': fingerprint,
+            'crash': crash,
+            'argv': argv,
+            'labels': labels,
+            'normalization': normalization,
+            'frames': frames or list()
+        })
+        taskqueue.Queue(CounterBuffer.__QUEUE_NAME__).add(taskqueue.Task(payload=payload, method='PULL', tag=name))
+        memcache.incr(CounterBuffer.pending_cache_key(name), 1, initial_value=0)
+
+    @classmethod
+    def lease(cls):
+        """
+        Leases the buffered reports. Returns the list of tasks, and a list of reports decoded from their payloads.
+        """
+        queue = taskqueue.Queue(CounterBuffer.__QUEUE_NAME__)
+        tasks = queue.lease_tasks(CounterBuffer.__LEASE_SECONDS__, CounterBuffer.__LEASE_SIZE__)
+        reports = list()
+        for task in tasks:
+            report = json.loads(task.payload)
+            report['frames'] = [tuple(frame) for frame in report.get('frames') or list()]
+            reports.append(report)
+        return tasks, reports
+
+    @classmethod
+    def aggregate(cls, reports):
+        """
+        Groups buffered reports by fingerprint and normalization. The most recent report wins for argv and labels.
+        Returns a dict of normalization -> dict of fingerprint -> aggregate (as expected by CrashReport.add_batch).
+        """
+        aggregates = dict()
+        for report in reports:
+            by_fingerprint = aggregates.setdefault(report.get('normalization'), dict())
+            fingerprint = report.get('fingerprint')
+            aggregate = by_fingerprint.get(fingerprint)
+            if aggregate is None:
+                by_fingerprint[fingerprint] = {
+                    'crash': report.get('crash'),
+                    'argv': report.get('argv'),
+                    'labels': report.get('labels'),
+                    'frames': report.get('frames'),
+                    'delta': 1
+                }
+            else:
+                aggregate['delta'] += 1
+                aggregate['argv'] = report.get('argv')
+                aggregate['labels'] = report.get('labels')
+        return aggregates
+
+    @classmethod
+    def complete(cls, tasks, aggregates):
+        """
+        Deletes the flushed reports from the queue, and takes them out of the pending counts.
+        """
+        taskqueue.Queue(CounterBuffer.__QUEUE_NAME__).delete_tasks(tasks)
+        offsets = dict()
+        for by_fingerprint in aggregates.values():
+            for fingerprint, aggregate in by_fingerprint.iteritems():
+                cache_key = CounterBuffer.pending_cache_key(CrashReport.key_name(fingerprint))
+                offsets[cache_key] = offsets.get(cache_key, 0) - aggregate.get('delta', 1)
+        memcache.offset_multi(offsets)
+
+
+class CounterReconciler(object):
+    """
+    Recomputes the true totals of recently active fingerprints from their shards, and repairs the cached totals
+    (and the materialized summaries) that have drifted.
+    """
+    __STATS_CACHE_KEY__ = 'counter_reconciliation_stats'
+    # fingerprints seen in this window are reconciled
+    __WINDOW__ = datetime.timedelta(hours=1)
+    __BATCH_SIZE__ = 100
+
+    @classmethod
+    def empty_stats(cls):
+        return {
+            'checked': 0,
+            'missing': 0,
+            'drifted': 0,
+            'repaired': 0,
+            'summaries_drifted': 0,
+            'total_drift': 0,
+            'max_drift': 0
+        }
+
+    @classmethod
+    def reconcile(cls, cursor=None, since=None, stats=None):
+        since = since or datetime.datetime.utcnow() - CounterReconciler.__WINDOW__
+        stats = stats or CounterReconciler.empty_stats()
+        q = CrashSummary.all()
+        q.filter('last_seen >=', since)
+        if cursor:
+            q.with_cursor(cursor)
+        summaries = q.fetch(limit=CounterReconciler.__BATCH_SIZE__)
+        if summaries:
+            CounterReconciler.reconcile_summaries(summaries, stats)
+            # schedule next request
+            deferred.defer(CounterReconciler.reconcile, cursor=q.cursor(), since=since, stats=stats)
+        else:
+            stats['finished'] = to_milliseconds(datetime.datetime.utcnow())
+            logging.info('Counter reconciliation finished %s', stats)
+            memcache.set(CounterReconciler.__STATS_CACHE_KEY__, stats)
+        return stats
+
+    @classmethod
+    def reconcile_summaries(cls, summaries, stats):
+        names = [summary.key().name() for summary in summaries]
+        client = memcache.Client()
+        cache_keys = dict((CrashReport.count_cache_key(name), name) for name in names)
+        # the cached totals are read (for cas) before the shards: an increment applied after the shard read
+        # also offsets the cached total, which makes the cas below fail instead of overwriting the increment
+        cached = client.get_multi(cache_keys.keys(), for_cas=True)
+
+        shard_keys = dict((name, CrashReport.shard_keys(name)) for name in names)
+        # one batch get for the shards of the whole page
+        shards = db.get([key for name in names for key in shard_keys.get(name)])
+        totals = dict()
+        for shard in shards:
+            if shard is not None:
+                totals[shard.name] = totals.get(shard.name, 0) + shard.count
+
+        to_repair = dict()
+        missing = dict()
+        for cache_key, name in cache_keys.iteritems():
+            total = totals.get(name, 0)
+            stats['checked'] += 1
+            if cache_key not in cached:
+                stats['missing'] += 1
+                missing[cache_key] = str(total)
+                continue
+            drift = abs(int(cached.get(cache_key)) - total)
+            if drift > 0:
+                stats['drifted'] += 1
+                stats['total_drift'] += drift
+                stats['max_drift'] = max(stats['max_drift'], drift)
+                to_repair[cache_key] = str(total)
+
+        # compare and set, so increments that raced with the shard reads are not overwritten
+        # (missing totals are only added: increments skip missing keys)
+        if to_repair:
+            failed = client.cas_multi(to_repair)
+            stats['repaired'] += len(to_repair) - len(failed)
+        if missing:
+            client.add_multi(missing)
+
+        # summaries with buffered reports are synced with the shards by their next rollup
+        pending = client.get_multi([CrashSummary.delta_cache_key(name) for name in names])
+        task_rpcs = list()
+        for summary in summaries:
+            name = summary.key().name()
+            if int(pending.get(CrashSummary.delta_cache_key(name)) or 0) > 0:
+                # in case the scheduled rollup was lost
+                task_rpcs.append(CrashSummary.rollup_later(name))
+            elif summary.count != totals.get(name, 0):
+                stats['summaries_drifted'] += 1
+                CrashSummary.rebuild_later(name)
+        wait_all(task_rpcs)
+
+    @classmethod
+    def stats(cls):
+        return memcache.get(CounterReconciler.__STATS_CACHE_KEY__)
+
+
+class CrashSummary(db.Model):
+    """
+    A materialized summary of all the shards of a fingerprint. New shards and changes of state are applied on
+    write, and the count and hotness are rolled up from buffered reports once a minute.
+    __key__ == name property in CrashReport
+    """
+    fingerprint = db.StringProperty()
+    count = db.IntegerProperty(default=0)
+    first_seen = db.DateTimeProperty()
+    last_seen = db.DateTimeProperty()
+    # state can be one of 'unresolved'|'pending'|'submitted'|'resolved'
+    state = db.StringProperty(default='unresolved')
+    issue = db.StringProperty(required=False)
+    labels = db.StringListProperty(default=[])
+    argv = db.StringListProperty(default=[])
+    snippet = db.TextProperty()
+    # exponentially decayed score, in the log domain and relative to the epoch (so scores are comparable)
+    hotness = db.FloatProperty()
+    # incremented on every update, so an older summary never overwrites a newer one in memcache
+    revision = db.IntegerProperty(default=0)
+
+    # number of lines in the snippet
+    __SNIPPET_LENGTH__ = 3
+    # the score of a crash halves every day
+    __HALF_LIFE__ = 86400.0
+    # cached summaries are written through on every update
+    __CACHE_TTL__ = 3600
+    __CAS_RETRIES__ = 2
+    # reports are rolled up into the summary (at most) once per interval (in seconds)
+    __ROLLUP_DELAY__ = 60
+
+    @classmethod
+    def decay(cls):
+        return math.log(2) / CrashSummary.__HALF_LIFE__
+
+    @classmethod
+    def add_hotness(cls, hotness, delta, date_time):
+        """
+        Adds delta reports at date_time to a decayed score, i.e. log(exp(hotness) + delta * exp(decay * t)).
+        """
+        value = CrashSummary.decay() * to_milliseconds(date_time) / 1000.0 + math.log(delta)
+        if hotness is None:
+            return value
+        high, low = max(hotness, value), min(hotness, value)
+        return high + math.log1p(math.exp(low - high))
+
+    @classmethod
+    def score(cls, hotness, date_time=None):
+        """
+        The decayed score of a crash at date_time (defaults to now).
+        """
+        if hotness is None:
+            return 0.0
+        date_time = date_time or datetime.datetime.utcnow()
+        return math.exp(hotness - CrashSummary.decay() * to_milliseconds(date_time) / 1000.0)
+
+    @classmethod
+    def snippet(cls, crash):
+        if not crash:
+            return None
+        lines = [line for line in crash.splitlines(True) if len(line.strip()) > 0]
+        return ''.join(lines[:CrashSummary.__SNIPPET_LENGTH__])
+
+    @classmethod
+    def to_dict(cls, summary):
+        if summary is None:
+            return {
+                'fingerprint': None,
+                'count': 0,
+                'first_seen': None,  # in millis
+                'time': None,  # in millis
+                'state': 'unresolved',
+                'issue': None,
+                'labels': list(),
+                'argv': list(),
+                'snippet': None,
+                'hotness': None,
+                'revision': -1
+            }
+        return {
+            'fingerprint': summary.fingerprint,
+            'count': summary.count,
+            'first_seen': to_milliseconds(summary.first_seen) if summary.first_seen else None,
+            'time': to_milliseconds(summary.last_seen) if summary.last_seen else None,
+            'state': summary.state,
+            'issue': summary.issue,
+            'labels': summary.labels,
+            'argv': summary.argv,
+            'snippet': summary.snippet,
+            'hotness': summary.hotness,
+            'revision': summary.revision
+        }
+
+    @classmethod
+    def rebuild(cls, name):
+        """
+        Rebuilds the summary from the shards of a fingerprint. Used to backfill summaries,
+        and to repair them when an incremental update fails. The accumulated hotness is kept.
+        """
+        summary = CrashReport.compute_summary(name)
+        if summary.get('fingerprint') is None:
+            # no shards left
+            db.delete(db.Key.from_path(cls.kind(), name))
+            memcache.delete(CrashReport.summary_cache_key(name))
+            return None
+        last_seen = from_milliseconds(summary.get('time'))
+
+        def txn():
+            existing = CrashSummary.get_by_key_name(name)
+            entity = CrashSummary(
+                key_name=name,
+                fingerprint=summary.get('fingerprint'),
+                count=summary.get('count'),
+                first_seen=from_milliseconds(summary.get('first_seen')),
+                # shards are stamped when they are created, the summary when reports are rolled up
+                last_seen=max(existing.last_seen or last_seen, last_seen) if existing else last_seen,
+                state=summary.get('state'),
+                issue=summary.get('issue'),
+                labels=summary.get('labels'),
+                argv=summary.get('argv'),
+                snippet=summary.get('snippet'),
+                hotness=existing.hotness if existing else None,
+                revision=existing.revision + 1 if existing else 0)
+            if entity.hotness is None and entity.count > 0:
+                # approximate the score, as if all the reports happened when the crash was last seen
+                entity.hotness = CrashSummary.add_hotness(None, entity.count, entity.last_seen)
+            entity.put()
+            return entity, existing is None
+
+        entity, created = db.run_in_transaction(txn)
+        if created:
+            # the buffered reports are already part of the approximated score
+            memcache.delete(CrashSummary.delta_cache_key(name))
+        CrashSummary.write_through([entity])
+        TrendingLeaderboard.update(name, entity.hotness)
+        return entity
+
+    @classmethod
+    def write_through(cls, summaries):
+        """
+        Writes updated summaries to memcache with compare and set. A cached summary is only replaced by one
+        with a higher revision, so updates that reach memcache out of order are not lost. When the compare
+        and set keeps failing, the cached summary is deleted, and the next read fetches it again.
+        """
+        if not summaries:
+            return
+        client = memcache.Client()
+        by_cache_key = dict((CrashReport.summary_cache_key(summary.key().name()), summary) for summary in summaries)
+        pending = by_cache_key.keys()
+        for retry in range(CrashSummary.__CAS_RETRIES__):
+            cached = client.get_multi(pending, for_cas=True)
+            to_cas = dict()
+            to_add = dict()
+            for cache_key in pending:
+                summary = by_cache_key.get(cache_key)
+                current = cached.get(cache_key)
+                if current is None:
+                    to_add[cache_key] = CrashSummary.to_dict(summary)
+                elif current.get('revision', -1) < summary.revision:
+                    to_cas[cache_key] = CrashSummary.to_dict(summary)
+            failed = list()
+            if to_cas:
+                failed.extend(client.cas_multi(to_cas, time=CrashSummary.__CACHE_TTL__))
+            if to_add:
+                failed.extend(client.add_multi(to_add, time=CrashSummary.__CACHE_TTL__))
+            pending = failed
+            if not pending:
+                return
+        client.delete_multi(pending)
+
+    @classmethod
+    def rebuild_later(cls, name):
+        try:
+            deferred.defer(CrashSummary.rebuild, name, _countdown=60,
+                           _name='rebuild-summary-{0}-{1}'.format(
+                               hashlib.md5(name).hexdigest(), int(time.time()) // 60))
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            # a rebuild is already scheduled
+            pass
+
+    @classmethod
+    def record(cls, name, argv=None, labels=None, state=None):
+        """
+        Applies a new shard (which becomes the most recent shard) to the summary of a fingerprint.
+        Returns the updated summary, or None when the update failed and a rebuild was scheduled.
+        The caller is responsible for writing the summary through to memcache (see write_through).
+        """
+        now = datetime.datetime.utcnow()
+
+        def txn():
+            summary = CrashSummary.get_by_key_name(name)
+            if summary is None:
+                return None
+            summary.last_seen = max(summary.last_seen or now, now)
+            if argv is not None:
+                summary.argv = argv
+            if labels is not None:
+                summary.labels = labels
+            if state is not None:
+                summary.state = state
+            summary.revision += 1
+            summary.put()
+            return summary
+
+        try:
+            summary = db.run_in_transaction(txn)
+            if summary is None:
+                # the shards already include this report
+                return CrashSummary.rebuild(name)
+            return summary
+        except (db.TransactionFailedError, db.Timeout):
+            logging.warning('Unable to update the summary for %s. Scheduling a rebuild.', name)
+            CrashSummary.rebuild_later(name)
+            return None
+
+    @classmethod
+    def delta_cache_key(cls, name):
+        return 'summary_delta_' + name
+
+    @classmethod
+    def offsets(cls, deltas):
+        """
+        The memcache offsets that buffer new reports until the next rollup. deltas is a dict of name -> reports.
+        """
+        return dict((CrashSummary.delta_cache_key(name), delta) for name, delta in deltas.iteritems())
+
+    @classmethod
+    def rollup_later(cls, name):
+        """
+        Starts scheduling a rollup, and returns the RPC.
+        """
+        return defer_async(CrashSummary.rollup, name, _countdown=CrashSummary.__ROLLUP_DELAY__)
+
+    @classmethod
+    def rollup(cls, name):
+        """
+        Applies the reports buffered since the last rollup to the summary. The count is recomputed from the shards,
+        and the buffered reports are added to the hotness (as if they all happened now).
+        """
+        cache_key = CrashSummary.delta_cache_key(name)
+        reports = int(memcache.get(cache_key) or 0)
+        remaining = 0
+        if reports > 0:
+            # take the reports out of the buffer first, so concurrent reports are not lost
+            remaining = memcache.decr(cache_key, reports) or 0
+        count = sum(shard.count for shard in CrashReport.get_shards(name))
+        now = datetime.datetime.utcnow()
+
+        def txn():
+            summary = CrashSummary.get_by_key_name(name)
+            if summary is None:
+                return None
+            summary.count = count
+            if reports > 0:
+                summary.last_seen = max(summary.last_seen or now, now)
+                summary.hotness = CrashSummary.add_hotness(summary.hotness, reports, now)
+            summary.revision += 1
+            summary.put()
+            return summary
+
+        try:
+            summary = db.run_in_transaction(txn)
+        except (db.TransactionFailedError, db.Timeout):
+            # put the reports back, and let the task queue retry
+            if reports > 0:
+                memcache.incr(cache_key, reports, initial_value=0)
+            raise
+        if summary is None:
+            CrashSummary.rebuild(name)
+        else:
+            CrashSummary.write_through([summary])
+            TrendingLeaderboard.update(name, summary.hotness)
+        if remaining > 0:
+            # reports that came in since the buffer was read did not schedule a rollup
+            CrashSummary.rollup_later(name).get_result()
+
+    @classmethod
+    def update(cls, name, delta_state):
+        """
+        Applies a change of mutable properties (state, issue, labels, argv) to the summary.
+        """
+        def txn():
+            summary = CrashSummary.get_by_key_name(name)
+            if summary is None:
+                return None
+            for property_name in ['state', 'issue', 'labels', 'argv']:
+                if property_name in delta_state:
+                    setattr(summary, property_name, delta_state.get(property_name))
+            summary.revision += 1
+            summary.put()
+            return summary
+
+        try:
+            summary = db.run_in_transaction(txn)
+            if summary is None:
+                CrashSummary.rebuild(name)
+            else:
+                CrashSummary.write_through([summary])
+        except (db.TransactionFailedError, db.Timeout):
+            logging.warning('Unable to update the summary for %s. Scheduling a rebuild.', name)
+            CrashSummary.rebuild_later(name)
+            memcache.delete(CrashReport.summary_cache_key(name))
+
+
+class TrendingLeaderboard(object):
+    """
+    A bounded top-K list of the hottest fingerprints, kept in memcache and updated at ingest time.
+    When evicted, it is rebuilt from the CrashSummary hotness index.
+    """
+    __CACHE_KEY__ = 'trending_leaderboard'
+    __SIZE__ = 100
+    __TTL__ = 3600
+    __CAS_RETRIES__ = 3
+    __OPEN_STATES__ = ['unresolved', 'pending', 'submitted']
+
+    # the leaderboard is also rebuilt from the index every 5 minutes, so it does not drift from the summaries
+    cache = StaleWhileRevalidate(soft_ttl=300, hard_ttl=__TTL__)
+
+    @classmethod
+    def rebuild(cls):
+        q = CrashSummary.all()
+        q.filter('state IN ', TrendingLeaderboard.__OPEN_STATES__)
+        q.order('-hotness')
+        return [(summary.hotness, summary.key().name()) for summary in q.fetch(limit=TrendingLeaderboard.__SIZE__)]
+
+    @classmethod
+    def top(cls):
+        """
+        Returns the list of (hotness, name) tuples, hottest first.
+        Only one request rebuilds an expired leaderboard, the others are served the stale leaderboard.
+        """
+        return TrendingLeaderboard.cache.get(TrendingLeaderboard.__CACHE_KEY__, TrendingLeaderboard.rebuild)
+
+    @classmethod
+    def update(cls, name, hotness):
+        """
+        Updates the score of a fingerprint. Only applies, if the leaderboard is already cached.
+        """
+        if hotness is None:
+            return
+        client = memcache.Client()
+        for retry in range(TrendingLeaderboard.__CAS_RETRIES__):
+            leaderboard = client.gets(TrendingLeaderboard.__CACHE_KEY__)
+            if leaderboard is None:
+                # will be rebuilt on the next read
+                return
+            entries = [entry for entry in leaderboard if entry[1] != name]
+            if len(entries) >= TrendingLeaderboard.__SIZE__ and hotness <= entries[-1][0]:
+                # not hot enough
+                return
+            entries.append((hotness, name))
+            entries.sort(reverse=True)
+            entries = entries[:TrendingLeaderboard.__SIZE__]
+            if client.cas(TrendingLeaderboard.__CACHE_KEY__, entries, time=TrendingLeaderboard.__TTL__):
+                return
+        logging.warning('Unable to update the trending leaderboard for %s', name)
+
+
+class CrashHistogram(db.Model):
+    """
+    Number of reports of a fingerprint in an hourly or a daily bucket.
+    Increments are buffered in memcache at ingest time, and rolled up into these entities by a deferred task.
+    __key__ == <name>_<resolution>_<bucket start in epoch seconds>
+    """
+    name = db.StringProperty()
+    resolution = db.StringProperty()
+    bucket = db.IntegerProperty()
+    count = db.IntegerProperty(default=0)
+
+    # resolution -> bucket width in seconds
+    __RESOLUTIONS__ = {
+        'hour': 3600,
+        'day': 86400
+    }
+    # resolution -> maximum number of buckets returned
+    __MAX_BUCKETS__ = {
+        'hour': 24 * 14,
+        'day': 90
+    }
+    # deltas are rolled up (at most) once per interval (in seconds)
+    __ROLLUP_DELAY__ = 60
+
+    @classmethod
+    def bucket_start(cls, resolution, timestamp):
+        width = CrashHistogram.__RESOLUTIONS__.get(resolution)
+        return int(timestamp) // width * width
+
+    @classmethod
+    def key_name(cls, name, resolution, bucket):
+        return '{0}_{1}_{2}'.format(name, resolution, bucket)
+
+    @classmethod
+    def delta_cache_key(cls, name, resolution, bucket):
+        return 'histogram_delta_' + CrashHistogram.key_name(name, resolution, bucket)
+
+    @classmethod
+    def pending_buckets(cls, timestamp):
+        """
+        The (resolution, bucket) pairs which can have buffered deltas, i.e. the current and the previous buckets.
+        """
+        buckets = list()
+        for resolution, width in sorted(CrashHistogram.__RESOLUTIONS__.items()):
+            current = CrashHistogram.bucket_start(resolution, timestamp)
+            buckets.append((resolution, current))
+            buckets.append((resolution, current - width))
+        return buckets
+
+    @classmethod
+    def offsets(cls, deltas, timestamp=None):
+        """
+        The memcache offsets that buffer new reports. deltas is a dict of name -> number of reports.
+        """
+        timestamp = timestamp or time.time()
+        offsets = dict()
+        for name, delta in deltas.iteritems():
+            for resolution in CrashHistogram.__RESOLUTIONS__.keys():
+                bucket = CrashHistogram.bucket_start(resolution, timestamp)
+                offsets[CrashHistogram.delta_cache_key(name, resolution, bucket)] = delta
+        return offsets
+
+    @classmethod
+    def should_rollup(cls, name, delta, results, timestamp=None):
+        """
+        Whether the report(s) found the buffer of the current hour empty, given the results of the offsets.
+        Every report increments the hourly bucket, so only this report has to schedule a rollup.
+        """
+        bucket = CrashHistogram.bucket_start('hour', timestamp or time.time())
+        return results.get(CrashHistogram.delta_cache_key(name, 'hour', bucket)) == delta
+
+    @classmethod
+    def rollup_later(cls, name):
+        """
+        Starts scheduling a rollup, and returns the RPC.
+        """
+        return defer_async(CrashHistogram.rollup, name, _countdown=CrashHistogram.__ROLLUP_DELAY__)
+
+    @classmethod
+    def rollup(cls, name):
+        """
+        Moves the buffered deltas of a fingerprint into the datastore.
+        """
+        buckets = CrashHistogram.pending_buckets(time.time())
+        cache_keys = [CrashHistogram.delta_cache_key(name, resolution, bucket) for resolution, bucket in buckets]
+        cached = memcache.get_multi(cache_keys)
+        deltas = dict()
+        for (resolution, bucket), cache_key in zip(buckets, cache_keys):
+            delta = int(cached.get(cache_key) or 0)
+            if delta > 0:
+                deltas[(resolution, bucket)] = (cache_key, delta)
+        if not deltas:
+            return
+
+        # take the deltas out of the buffer first, so concurrent increments are not lost
+        remaining = memcache.offset_multi(dict((cache_key, -delta) for cache_key, delta in deltas.values()))
+
+        def txn(resolution, bucket, delta):
+            key_name = CrashHistogram.key_name(name, resolution, bucket)
+            histogram = CrashHistogram.get_by_key_name(key_name)
+            if histogram is None:
+                histogram = CrashHistogram(
+                    key_name=key_name, name=name, resolution=resolution, bucket=bucket, count=0)
+            histogram.count += delta
+            histogram.put()
+
+        applied = list()
+        try:
+            for (resolution, bucket), (cache_key, delta) in deltas.iteritems():
+                db.run_in_transaction(txn, resolution, bucket, delta)
+                applied.append((resolution, bucket))
+        except (db.TransactionFailedError, db.Timeout):
+            # put the remaining deltas back, and let the task queue retry
+            memcache.offset_multi(
+                dict((cache_key, delta) for bucket, (cache_key, delta) in deltas.iteritems() if bucket not in applied),
+                initial_value=0)
+            raise
+        if any(int(value or 0) > 0 for value in (remaining or dict()).values()):
+            # increments that came in since the buffer was read did not schedule a rollup
+            CrashHistogram.rollup_later(name).get_result()
+
+    @classmethod
+    def histogram(cls, name, resolution='hour', buckets=24, timestamp=None):
+        """
+        Returns the number of reports in the last n buckets, oldest first.
+        Includes the deltas that have not been rolled up yet.
+        """
+        if resolution not in CrashHistogram.__RESOLUTIONS__:
+            raise ValueError('Unknown resolution {0}'.format(resolution))
+        buckets = max(1, min(buckets, CrashHistogram.__MAX_BUCKETS__.get(resolution)))
+        width = CrashHistogram.__RESOLUTIONS__.get(resolution)
+        end = CrashHistogram.bucket_start(resolution, timestamp or time.time())
+        starts = [end - width * i for i in reversed(range(buckets))]
+        entities = CrashHistogram.get_by_key_name(
+            [CrashHistogram.key_name(name, resolution, start) for start in starts])
+        # only the last two buckets can have pending deltas
+        pending_keys = dict((CrashHistogram.delta_cache_key(name, resolution, start), start) for start in starts[-2:])
+        pending = memcache.get_multi(pending_keys.keys())
+        pending_by_bucket = dict((pending_keys.get(cache_key), int(delta or 0))
+                                 for cache_key, delta in pending.iteritems())
+        counts = [(entity.count if entity else 0) + pending_by_bucket.get(start, 0)
+                  for start, entity in zip(starts, entities)]
+        return {
+            'resolution': resolution,
+            'interval': width,
+            'start': starts[0],
+            'counts': counts
         }
 
 
@@ -0,0 +1,86 @@
+import logging
+import re
+
+# bump this whenever the behavior of an existing rule changes
+__RULES_VERSION__ = '1'
+
+
+class Rule(object):
+    """
+    A single normalization rule. Rules are applied to one line at a time.
+    """
+    def __init__(self, name, pattern, replacement):
+        self.name = name
+        self.regex = re.compile(pattern, re.UNICODE)
+        self.replacement = replacement
+
+    def apply(self, line):
+        return self.regex.sub(self.replacement, line)
+
+
+# rules are applied in this order
+RULES = [
+    # /usr/local/lib/node_modules/t2-cli/lib/tessel.js => t2-cli/lib/tessel.js
+    Rule('node_modules', r'(?:[A-Za-z]:)?[^\s()]*[\\/]node_modules[\\/]', ''),
+    # /Users/name/projects/t2-cli/lib/tessel.js => t2-cli/lib/tessel.js (same as an install from node_modules)
+    Rule('package_root',
+         r'(?<![^\s(])(?:[A-Za-z]:)?[\\/](?:[^\s()\\/]+[\\/])*?(?=[^\s()\\/]+[\\/](?:lib|bin|src|test)[\\/])', ''),
+    # /Users/name/t2-cli.js => ~/t2-cli.js
+    Rule('home', r'(?:[A-Za-z]:)?[\\/](?:Users|home|Documents and Settings)[\\/][^\s()\\/]+', '~'),
+    # t2-cli\bin\tessel-2.js => t2-cli/bin/tessel-2.js
+    Rule('separators', r'\\', '/'),
+    # timers.js:110:15 => timers.js:110
+    Rule('columns', r'(\.\w+:\d+):\d+', r'\1'),
+    # at null._onTimeout => at _onTimeout, at Object.<anonymous> => at <anonymous>
+    Rule('anonymous', r'(\bat\s+)(?:null|undefined|Object|console)\.', r'\1'),
+    # 0x7fff5fbff8c8 => 0x?
+    Rule('addresses', r'\b0x[0-9a-fA-F]+\b', '0x?'),
+    # 02a3f4b5c6d7 => ? (device serial numbers, commit hashes, ...)
+    Rule('hex_ids', r'\b(?=[0-9a-fA-F]*[0-9])(?=[0-9a-fA-F]*[a-fA-F])[0-9a-fA-F]{8,}\b', '?'),
+]
+
+RULES_BY_NAME = dict((rule.name, rule) for rule in RULES)
+
+DEFAULT_RULES = ','.join(rule.name for rule in RULES)
+
+
+class Normalizer(object):
+    """
+    Normalizes stack traces before they are fingerprinted, so the same crash on different installs
+    of the CLI end up with the same fingerprint.
+    """
+    def __init__(self, rule_names=DEFAULT_RULES):
+        names = [name.strip() for name in (rule_names or '').split(',') if len(name.strip()) > 0]
+        unknown = [name for name in names if name not in RULES_BY_NAME]
+        if unknown:
+            logging.warning('Ignoring unknown normalization rules %s', ','.join(unknown))
+        # keep the canonical ordering of the rules
+        self.rules = [rule for rule in RULES if rule.name in names]
+
+    @property
+    def version(self):
+        return '{0}:{1}'.format(__RULES_VERSION__, ','.join(rule.name for rule in self.rules))
+
+    def normalize_line(self, line):
+        for rule in self.rules:
+            line = rule.apply(line)
+        return line
+
+    def normalize(self, trace):
+        if not trace:
+            return trace
+        return ''.join(self.normalize_line(line) for line in trace.splitlines(True))
+
+
+__NORMALIZERS__ = dict()
+
+
+def get_normalizer(rule_names=DEFAULT_RULES):
+    """
+    Returns a (cached) normalizer for the given comma separated list of rules.
+    """
+    normalizer = __NORMALIZERS__.get(rule_names)
+    if normalizer is None:
+        normalizer = Normalizer(rule_names)
+        __NORMALIZERS__[rule_names] = normalizer
+    return normalizer
@@ -59,6 +59,34 @@ class Search(object):
             except search.Error, e:
                 logging.exception('Unable to add documents to index', e)
 
+    @classmethod
+    def add_crash_reports_async(cls, crash_reports):
+        """
+        Starts indexing the crash reports, and returns the RPC (or None). Use Search.wait to get the result.
+        """
+        if crash_reports:
+            documents = [Search.crash_report_to_document(crash_report) for crash_report in crash_reports]
+            index = search.Index(name=__INDEX__)
+            return index.put_async(documents)
+        return None
+
+    @classmethod
+    def wait(cls, rpc):
+        if rpc is not None:
+            try:
+                rpc.get_result()
+            except search.Error, e:
+                logging.exception('Unable to add documents to index', e)
+
+    @classmethod
+    def remove_documents(cls, document_ids):
+        if document_ids:
+            try:
+                index = search.Index(name=__INDEX__)
+                index.delete(document_ids)
+            except search.Error, e:
+                logging.exception('Unable to remove documents from index', e)
+
     @classmethod
     def search(cls, query, cursor=None, limit=25):
         # documentation for the query string format is at
@@ -87,6 +115,9 @@ class Search(object):
             query = search.Query(query_string=query, options=query_options)
             # search
             results = index.search(query)
+            # fetch the counts for all the results at once
+            counts = CrashReport.get_counts(
+                list(set(CrashReport.key_name(Search._find_first(document, 'fingerprint')) for document in results)))
             fingerprints = set()
             models = list()
             for document in results:
@@ -98,7 +129,7 @@ class Search(object):
                     'labels': Search._find_fields(document, 'labels'),
                     'fingerprint': fingerprint,
                     'time': to_milliseconds(Search._find_first(document, 'time')),  # in millis
-                    'count': CrashReport.get_count(CrashReport.key_name(Search._find_first(document, 'fingerprint'))),
+                    'count': counts.get(CrashReport.key_name(fingerprint)),
                     'issue': Search._find_first(document, 'issue')
                 }
                 # de-dupe fingerprints
@@ -1,16 +1,288 @@
-def sim_hash(trace, limit=512):
+import re
+
+# bump this whenever the fingerprint of a trace changes (memoized fingerprints are keyed by it)
+__SIM_HASH_VERSION__ = '2'
+# 64 bit FNV-1a parameters
+__FNV_OFFSET_BASIS__ = 0xcbf29ce484222325
+__FNV_PRIME__ = 0x100000001b3
+__MASK_64__ = 0xffffffffffffffff
+# number of bits in a fingerprint
+__BITS__ = 64
+# a token with a location (file.js:110) votes with its file at full weight, and with the whole location at a
+# light weight, so a frame that moved by a few lines only changes a light token (tuned with benchmark.py)
+__TOKEN_WEIGHT__ = 4
+__LOCATION_WEIGHT__ = 1
+__LOCATION__ = re.compile(r'^(.+?):\d+', re.UNICODE)
+# fingerprints within these many bits are considered near duplicates
+__NEAR_DUPLICATE_DISTANCE__ = 4
+# every bit of a token hash is spread to a field of these many bits, so that a token votes on all the bits of
+# the fingerprint with a single (long) integer addition
+__FIELD_BITS__ = 32
+__FIELD_MASK__ = (1 << __FIELD_BITS__) - 1
+__SPREAD_BYTES__ = [sum(((byte >> bit) & 1) << (bit * __FIELD_BITS__) for bit in range(8)) for byte in range(256)]
+# the spread hashes of the most recent tokens (most tokens are the same few function and file names)
+__TOKEN_CACHE_SIZE__ = 64 * 1024
+__TOKEN_CACHE__ = dict()
+# line breaks, matching the behavior of splitlines()
+__LINE_BREAKS__ = re.compile(r'\r\n|[\r\n]')
+__UNICODE_LINE_BREAKS__ = re.compile(u'\r\n|[\r\n\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]', re.UNICODE)
+__WHITESPACE__ = re.compile(r'\s')
+__UNICODE_WHITESPACE__ = re.compile(r'\s', re.UNICODE)
+# traces are tokenized in chunks of (roughly) these many characters
+__CHUNK_SIZE__ = 64 * 1024
+# only the beginning of a trace is fingerprinted (runaway recursion dumps repeat the same few frames)
+__MAX_LINES__ = 1000
+__MAX_CHARACTERS__ = 64 * 1024
+
+
+def fnv1a_64(token):
+    """
+    A deterministic 64 bit hash over the UTF-8 bytes of a token.
+    Unlike the built-in hash(), this does not depend on the interpreter build or on hash randomization.
+    """
+    if isinstance(token, unicode):
+        token = token.encode('utf-8')
+    result = __FNV_OFFSET_BASIS__
+    for byte in bytearray(token):
+        result ^= byte
+        result = (result * __FNV_PRIME__) & __MASK_64__
+    return result
+
+
+def _legacy_tokens(trace):
+    lines = trace.splitlines(True)
+    words = []
+    for line in lines:
+        word_list = line.split()
+        filter_list = [word for word in word_list if len(word) > 0]
+        words.extend(filter_list)
+
+    split_set = set(words)
+    # preserve ordering when computing the split list
+    return [word for word in words if word in split_set]
+
+
+def _iter_lines(trace, max_characters=None):
+    """
+    Lazily yields the same lines as trace.splitlines(), for the first max_characters of the trace (if specified).
+    The trace is split one chunk at a time, so only a single chunk worth of lines is materialized.
+    A line longer than a chunk is yielded in pieces, cut at whitespace (when there is any).
+    """
+    if isinstance(trace, unicode):
+        line_breaks, whitespace = __UNICODE_LINE_BREAKS__, __UNICODE_WHITESPACE__
+    else:
+        line_breaks, whitespace = __LINE_BREAKS__, __WHITESPACE__
+    start = 0
+    length = len(trace) if max_characters is None else min(len(trace), max_characters)
+    while start < length:
+        end = start + __CHUNK_SIZE__
+        if end < length:
+            # extend the chunk to the end of the line, or to the next token of a long line
+            limit = end + __CHUNK_SIZE__
+            if limit >= length:
+                match = line_breaks.search(trace, end, length)
+                end = match.end() if match else length
+            else:
+                match = line_breaks.search(trace, end, limit) or whitespace.search(trace, end, limit)
+                if match:
+                    end = match.end()
+        else:
+            end = length
+        for line in trace[start:end].splitlines():
+            yield line
+        start = end
+
+
+def weighted_tokens(trace, limit=512, normalizer=None, max_lines=__MAX_LINES__, max_characters=__MAX_CHARACTERS__):
+    """
+    Yields unique (token, weight) tuples in the order they appear in the trace. Stops after limit unique tokens,
+    max_lines lines or max_characters characters, whichever comes first.
+    A token with a location (e.g. (timers.js:110)) yields its file at full weight, and then the whole token at
+    a light weight.
+    Lines are read (and normalized) one at a time, so memory does not grow with the size of the trace.
+    """
+    seen = set()
+    line_number = 0
+    for line in _iter_lines(trace, max_characters=max_characters):
+        if line_number >= max_lines:
+            return
+        if normalizer:
+            line = normalizer.normalize_line(line)
+        # only a single line (at most a chunk) is split at a time
+        words = line.split()
+        if not words:
+            continue
+        line_number += 1
+        for word in words:
+            location = __LOCATION__.match(word)
+            if location:
+                tokens = ((location.group(1), __TOKEN_WEIGHT__), (word, __LOCATION_WEIGHT__))
+            else:
+                tokens = ((word, __TOKEN_WEIGHT__),)
+            for token, weight in tokens:
+                if token not in seen:
+                    seen.add(token)
+                    yield token, weight
+                    if len(seen) >= limit:
+                        return
+
+
+def _spread(token_hash):
+    """
+    Spreads the 64 bits of a hash to 64 fields of __FIELD_BITS__ bits (bit i is the lowest bit of field i).
+    """
+    result = 0
+    for index in range(__BITS__ // 8):
+        result |= __SPREAD_BYTES__[(token_hash >> (8 * index)) & 0xff] << (8 * __FIELD_BITS__ * index)
+    return result
+
+
+def _token_votes(token, hash_function):
+    if hash_function is not fnv1a_64:
+        return _spread(hash_function(token))
+    votes = __TOKEN_CACHE__.get(token)
+    if votes is None:
+        if len(__TOKEN_CACHE__) >= __TOKEN_CACHE_SIZE__:
+            __TOKEN_CACHE__.clear()
+        votes = _spread(fnv1a_64(token))
+        __TOKEN_CACHE__[token] = votes
+    return votes
+
+
+def sim_hash(trace, limit=512, hash_function=fnv1a_64, normalizer=None):
+    """
+    A weighted SimHash. Every token votes on each bit of the fingerprint with its weight,
+    so similar traces end up with fingerprints that are a small Hamming distance apart.
+    The votes of all the tokens are summed at once: field i of counts is the weight of the tokens with bit i set.
+    """
+    if trace:
+        counts = 0
+        total = 0
+        for token, weight in weighted_tokens(trace, limit=limit, normalizer=normalizer):
+            counts += weight * _token_votes(token, hash_function)
+            total += weight
+        result = 0
+        for bit in range(__BITS__):
+            # a bit is set when the tokens with the bit set outweigh the others
+            if 2 * ((counts >> (bit * __FIELD_BITS__)) & __FIELD_MASK__) > total:
+                result |= 1 << bit
+        return unicode('0x%016x' % result)
+    else:
+        return None
+
+
+def _fnv1a_64_batch(numpy, tokens):
+    """
+    Vectorized FNV-1a over a list of byte strings. Returns a numpy uint64 array of hashes.
+    """
+    lengths = numpy.array([len(token) for token in tokens], dtype=numpy.int64)
+    # sort by length (longest first), so the tokens still being hashed are always a prefix
+    order = numpy.argsort(-lengths, kind='mergesort')
+    sorted_lengths = lengths[order]
+    offsets = numpy.zeros(len(tokens), dtype=numpy.int64)
+    offsets[1:] = numpy.cumsum(lengths)[:-1]
+    offsets = offsets[order]
+    data = numpy.frombuffer(b''.join(tokens), dtype=numpy.uint8).astype(numpy.uint64)
+
+    prime = numpy.uint64(__FNV_PRIME__)
+    hashes = numpy.empty(len(tokens), dtype=numpy.uint64)
+    hashes.fill(numpy.uint64(__FNV_OFFSET_BASIS__))
+    max_length = sorted_lengths[0] if len(tokens) > 0 else 0
+    for position in range(max_length):
+        active = numpy.searchsorted(-sorted_lengths, -position, side='left')
+        hashes[:active] = (hashes[:active] ^ data[offsets[:active] + position]) * prime
+
+    result = numpy.empty(len(tokens), dtype=numpy.uint64)
+    result[order] = hashes
+    return result
+
+
+def sim_hash_batch(traces, limit=512, normalizer=None):
+    """
+    Computes sim_hash for a list of traces using vectorized bit operations.
+    The results are identical to calling sim_hash on every trace. Requires numpy.
+    """
+    import numpy
+
+    token_ids = dict()
+    unique_tokens = list()
+    owners = list()
+    ids = list()
+    weights = list()
+    for owner, trace in enumerate(traces):
+        if not trace:
+            continue
+        for token, weight in weighted_tokens(trace, limit=limit, normalizer=normalizer):
+            if isinstance(token, unicode):
+                token = token.encode('utf-8')
+            token_id = token_ids.get(token)
+            if token_id is None:
+                token_id = len(unique_tokens)
+                token_ids[token] = token_id
+                unique_tokens.append(token)
+            owners.append(owner)
+            ids.append(token_id)
+            weights.append(weight)
+
+    if unique_tokens:
+        # hash every unique token once
+        hashes = _fnv1a_64_batch(numpy, unique_tokens)[numpy.array(ids, dtype=numpy.int64)]
+        owners = numpy.array(owners, dtype=numpy.int64)
+        weights = numpy.array(weights, dtype=numpy.int64)
+        values = numpy.zeros(len(traces), dtype=numpy.uint64)
+        for bit in range(__BITS__):
+            bits = ((hashes >> numpy.uint64(bit)) & numpy.uint64(1)).astype(numpy.int64)
+            # +weight for a set bit and -weight otherwise, summed per trace
+            votes = numpy.bincount(owners, weights=(2 * bits - 1) * weights, minlength=len(traces))
+            values |= (votes > 0).astype(numpy.uint64) << numpy.uint64(bit)
+    else:
+        values = numpy.zeros(len(traces), dtype=numpy.uint64)
+
+    return [unicode('0x%016x' % int(value)) if trace else None for trace, value in zip(traces, values)]
+
+
+def parse_fingerprint(fingerprint):
+    """
+    Returns the integer value of a fingerprint, or None for fingerprints that are not SimHash fingerprints.
+    """
+    try:
+        value = int(fingerprint, 16)
+    except (TypeError, ValueError):
+        return None
+    if value < 0 or value > __MASK_64__:
+        return None
+    return value
+
+
+def hamming_distance(first, second):
+    return bin(first ^ second).count('1')
+
+
+def permuted_blocks(value, max_distance=__NEAR_DUPLICATE_DISTANCE__):
+    """
+    Splits a fingerprint into (max_distance + 1) blocks. If two fingerprints are within max_distance bits,
+    at least one of their blocks is identical, so each block can be used as the prefix of a permuted table.
+    Returns a list of (block index, block value) tuples.
+    """
+    blocks = max_distance + 1
+    blocks_list = list()
+    start = 0
+    for index in range(blocks):
+        end = __BITS__ * (index + 1) // blocks
+        width = end - start
+        blocks_list.append((index, (value >> start) & ((1 << width) - 1)))
+        start = end
+    return blocks_list
+
+
+def legacy_sim_hash(trace, limit=512):
+    """
+    The fingerprint used before the stable hash family was introduced (built-in hash()).
+    Only useful when migrating existing fingerprints.
+    """
     if trace:
         result = 0
-        lines = trace.splitlines(True)
-        words = []
-        for line in lines:
-            word_list = line.split()
-            filter_list = [word for word in word_list if len(word) > 0]
-            words.extend(filter_list)
-
-        split_set = set(words)
-        # preserve ordering when computing the split list
-        split_list = [word for word in words if word in split_set]
+        split_list = _legacy_tokens(trace)
         for i in range(min(len(split_list), limit)):
             result ^= hash(split_list[i])
         return unicode(hex(result))
@@ -31,6 +303,10 @@ def main():
               '''
     print('sim_hash  = %s' % (sim_hash(trace_1)))
     print('sim_hash  = %s' % (sim_hash(trace_2)))
+    print('hamming_distance  = %s' % (
+        hamming_distance(parse_fingerprint(sim_hash(trace_1)), parse_fingerprint(sim_hash(trace_2)))))
+    print('legacy_sim_hash  = %s' % (legacy_sim_hash(trace_1)))
+    print('legacy_sim_hash  = %s' % (legacy_sim_hash(trace_2)))
 
 
 if __name__ == '__main__':
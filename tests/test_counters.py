@@ -0,0 +1,125 @@
+"""
+Concurrency tests for the sharded crash counters.
+
+Run them with the App Engine SDK on the path (from the root of the repository):
+    python -m unittest discover -s tests
+"""
+import os
+import sys
+import threading
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+try:
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+except ImportError:
+    pass
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+from google.appengine.ext import testbed
+
+from model import CrashReport
+
+
+class CounterStressTest(unittest.TestCase):
+    __THREADS__ = 8
+    __INCREMENTS__ = 10
+    __MAX_TASK_ATTEMPTS__ = 20
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        # every write is applied right away, so a query sees every shard
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def run_deferred(self):
+        """
+        Runs the deferred tasks (e.g. retried add_batch deltas and rollups) until there are none left.
+        Tasks that fail because of contention are retried, like the task queue would. Any other error fails the test.
+        """
+        pending = list()
+        for attempt in range(self.__MAX_TASK_ATTEMPTS__):
+            for queue in self.taskqueue.GetQueues():
+                pending.extend(self.taskqueue.GetTasks(queue.get('name')))
+                self.taskqueue.FlushQueue(queue.get('name'))
+            if not pending:
+                return
+            tasks, pending = pending, list()
+            for task in tasks:
+                if task.get('url') != '/_ah/queue/deferred':
+                    continue
+                try:
+                    deferred.run(task.get('body').decode('base64'))
+                except db.TransactionFailedError:
+                    pending.append(task)
+        self.fail('Deferred tasks still pending after {0} attempts'.format(self.__MAX_TASK_ATTEMPTS__))
+
+    def run_threads(self, function):
+        errors = list()
+
+        def worker(index):
+            for increment in range(self.__INCREMENTS__):
+                try:
+                    function(index, increment)
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(index,)) for index in range(self.__THREADS__)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def shard_total(self, fingerprint):
+        return sum(shard.count for shard in CrashReport.get_shards(CrashReport.key_name(fingerprint)))
+
+    def test_add_or_remove(self):
+        errors = self.run_threads(lambda index, increment: CrashReport.add_or_remove('fingerprint', 'crash'))
+        self.run_deferred()
+        self.assertEqual(list(), errors)
+        self.assertEqual(self.__THREADS__ * self.__INCREMENTS__, self.shard_total('fingerprint'))
+
+    def test_add_batch(self):
+        def add_batch(index, increment):
+            CrashReport.add_batch({
+                'first': {'crash': 'first crash', 'delta': 2},
+                'second': {'crash': 'second crash', 'delta': 1}
+            })
+
+        errors = self.run_threads(add_batch)
+        # deltas that could not be applied right away are applied by deferred tasks
+        self.run_deferred()
+        self.assertEqual(list(), errors)
+        batches = self.__THREADS__ * self.__INCREMENTS__
+        self.assertEqual(2 * batches, self.shard_total('first'))
+        self.assertEqual(batches, self.shard_total('second'))
+
+    def test_add_or_remove_and_add_batch(self):
+        def increment(index, increment):
+            if index % 2 == 0:
+                CrashReport.add_or_remove('fingerprint', 'crash')
+            else:
+                CrashReport.add_batch({'fingerprint': {'crash': 'crash', 'delta': 3}})
+
+        errors = self.run_threads(increment)
+        self.run_deferred()
+        self.assertEqual(list(), errors)
+        expected = (self.__THREADS__ // 2) * self.__INCREMENTS__ * (1 + 3)
+        self.assertEqual(expected, self.shard_total('fingerprint'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the batch (numpy) SimHash. They are skipped when numpy is not installed.
+
+    python -m unittest discover -s tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from normalizer import get_normalizer
+from simhash import __CHUNK_SIZE__, sim_hash, sim_hash_batch
+
+TRACE = u'''Error: connect ECONNREFUSED 192.168.1.101:22
+    at null._onTimeout (/usr/local/lib/node_modules/t2-cli/lib/tessel/deploy.js:7:29)
+    at Timer.listOnTimeout [as ontimeout] (timers.js:110:15)'''
+
+UNICODE_TRACE = u'''Error: Impossible de se connecter à la carte Tessel (« 02a3f4b5c6d7 »)
+    at Tessel.connectToNetwork (C:\\Users\\ana\\AppData\\Roaming\\npm\\node_modules\\t2-cli\\lib\\tessel\\wifi.js:12:5)
+    at 无法连接到 (/Users/kelsey/projects/t2-cli/lib/controller.js:88:1)'''
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class SimHashBatchTest(unittest.TestCase):
+    def traces(self):
+        frame = u'    at Tessel.getName (/home/pi/lib/node_modules/t2-cli/lib/tessel.js:{0}:9)'
+        return [
+            TRACE,
+            u'',
+            None,
+            u'   \n\t  \n',
+            UNICODE_TRACE,
+            UNICODE_TRACE.encode('utf-8'),
+            # runaway recursion, longer than a chunk
+            u'RangeError: Maximum call stack size exceeded\n' + u'\n'.join(frame.format(i) for i in range(5000)),
+            # a single line, longer than a chunk
+            u' '.join(u'token{0}'.format(i) for i in range(__CHUNK_SIZE__ // 4)),
+            TRACE,
+        ]
+
+    def assert_same(self, normalizer=None):
+        traces = self.traces()
+        self.assertTrue(any(len(trace) > __CHUNK_SIZE__ for trace in traces if trace))
+        expected = [sim_hash(trace, normalizer=normalizer) for trace in traces]
+        self.assertEqual(expected, sim_hash_batch(traces, normalizer=normalizer))
+
+    def test_matches_sim_hash(self):
+        self.assert_same()
+
+    def test_matches_normalized_sim_hash(self):
+        self.assert_same(normalizer=get_normalizer())
+
+    def test_empty_batch(self):
+        self.assertEqual(list(), sim_hash_batch([]))
+
+    def test_only_empty_traces(self):
+        traces = [None, u'', u'  \n ']
+        self.assertEqual([sim_hash(trace) for trace in traces], sim_hash_batch(traces))
+
+
+if __name__ == '__main__':
+    unittest.main()
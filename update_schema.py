@@ -4,10 +4,15 @@ import webapp2
 from google.appengine.ext import db
 from google.appengine.ext import deferred
 
-from model import CrashReport
+from frames import frame_sim_hash, parse_frames
+from model import CrashReport, FingerprintBucket, run_in_parallel
 from search_model import Search
+from simhash import legacy_sim_hash, parse_fingerprint, sim_hash_batch
+from util import CrashReports
 
 BATCH_SIZE = 100
+# page size for the fingerprint migration
+MIGRATION_BATCH_SIZE = 500
 
 
 class SchemaUpdater(object):
@@ -42,6 +47,85 @@ class SchemaUpdater(object):
             deferred.defer(SchemaUpdater.update, cursor=query.cursor())
 
 
+class FingerprintMigration(object):
+    """
+    Rekeys crash reports, whose fingerprint was computed with the legacy hash function, an older SimHash
+    or an older set of normalization rules. Also used to roll out changes to the normalization rules.
+    The legacy and stable fingerprints are computed side by side, so we can tell how many crash reports move.
+    """
+    @classmethod
+    def migrate(cls, cursor=None, dry_run=False):
+        logging.info('Migrating fingerprints for Crash Reports (Cursor = %s)' % unicode(cursor))
+        query = CrashReport.all()
+        if cursor:
+            query.with_cursor(cursor)
+
+        crash_reports = query.fetch(limit=MIGRATION_BATCH_SIZE)
+        normalizer = CrashReports.normalizer()
+        top_frames = CrashReports.top_frames()
+        # fingerprint the whole page at once
+        fingerprints = sim_hash_batch([crash_report.crash for crash_report in crash_reports], normalizer=normalizer)
+        if top_frames > 0:
+            fingerprints = [frame_sim_hash(crash_report.crash, top_frames, normalizer=normalizer) or fingerprint
+                            for crash_report, fingerprint in zip(crash_reports, fingerprints)]
+        # attach to near duplicates if they exist (a dry run does not register new fingerprints)
+        fingerprints = FingerprintBucket.resolve(fingerprints, register=not dry_run)
+        moved = list()
+        touched = list()
+        for crash_report, fingerprint in zip(crash_reports, fingerprints):
+            if crash_report.fingerprint == fingerprint:
+                changes = dict()
+                if crash_report.normalization != normalizer.version:
+                    # same fingerprint, only the rule set version changes
+                    changes['normalization'] = normalizer.version
+                if not crash_report.frames:
+                    # backfill stack frames
+                    frame_properties = CrashReport.frame_properties(
+                        parse_frames(crash_report.crash, normalizer=normalizer))
+                    if frame_properties.get('frames'):
+                        changes.update(frame_properties)
+                if changes:
+                    touched.append((crash_report.key(), changes))
+                continue
+            if parse_fingerprint(crash_report.fingerprint) is None:
+                legacy_fingerprint = legacy_sim_hash(crash_report.crash)
+                if crash_report.fingerprint != legacy_fingerprint:
+                    logging.warning('Legacy fingerprint mismatch for %s (computed %s)',
+                                    crash_report.fingerprint, legacy_fingerprint)
+            logging.info('Rekeying %s => %s', crash_report.fingerprint, fingerprint)
+            if not dry_run:
+                old_document_id = unicode(crash_report.key())
+                rekeyed = CrashReport.rekey(crash_report, fingerprint, normalization=normalizer.version)
+                if rekeyed is not None:
+                    Search.remove_documents([old_document_id])
+                    moved.append(rekeyed)
+
+        if touched and not dry_run:
+            # every shard is updated in its own transaction, so that concurrent increments are not overwritten
+            run_in_parallel(
+                lambda key, changes: db.run_in_transaction(FingerprintMigration.update_shard, key, changes), touched)
+
+        if crash_reports:
+            logging.info('Rekeyed %s of %s entities', len(moved), len(crash_reports))
+            Search.add_crash_reports(moved)
+            # schedule next request
+            deferred.defer(FingerprintMigration.migrate, cursor=query.cursor(), dry_run=dry_run)
+
+    @classmethod
+    def update_shard(cls, key, changes):
+        """
+        Re-reads a shard (in a transaction), and sets the properties in changes.
+        """
+        crash_report = CrashReport.get(key)
+        if crash_report is None:
+            # moved in the meantime
+            return None
+        for name, value in changes.iteritems():
+            setattr(crash_report, name, value)
+        crash_report.put()
+        return crash_report
+
+
 class RemoveSearchIndexes(webapp2.RequestHandler):
     def get(self):
         deferred.defer(SchemaUpdater.delete_search_indexes)
@@ -56,3 +140,12 @@ class UpdateSchemaHandler(webapp2.RequestHandler):
         message = 'Schema Updates Started'
         logging.info(message)
         self.response.out.write(message)
+
+
+class MigrateFingerprintsHandler(webapp2.RequestHandler):
+    def get(self):
+        dry_run = self.request.get('dry_run', 'false') == 'true'
+        deferred.defer(FingerprintMigration.migrate, dry_run=dry_run)
+        message = 'Fingerprint Migration Started (dry run = %s)' % dry_run
+        logging.info(message)
+        self.response.out.write(message)
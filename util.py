@@ -1,11 +1,21 @@
+import datetime
+import hashlib
+import json
+import logging
 import os
+import time
 
+from google.appengine.api import taskqueue
 from google.appengine.ext import db
-from google.appengine.ext.db import Key
+from google.appengine.ext import deferred
 
-from model import CrashReport
+from cache import TwoTierCache, memoize
+from frames import frame_sim_hash, parse_frames
+from model import CounterBuffer, CrashReport, CrashSummary, FingerprintBucket, GlobalPreferences, TrendingLeaderboard, \
+    run_in_parallel
+from normalizer import DEFAULT_RULES, get_normalizer
 from search_model import Search
-from simhash import sim_hash
+from simhash import __SIM_HASH_VERSION__, sim_hash
 
 
 def crash_uri(fingerprint):
@@ -32,22 +42,254 @@ class CrashReportException(Exception):
     """
 
 
+class FingerprintMemo(object):
+    """
+    Memoizes the fingerprints of exact (stripped) traces. Most incoming traces are repeats of a few hot crashes,
+    so we can skip normalizing and hashing them. The in-process LRU is backed by memcache, so the memo
+    is shared across instances.
+    """
+    __CAPACITY__ = 4096
+    __TTL__ = 86400
+    __CHUNK_SIZE__ = 64 * 1024
+
+    # a trace always has the same fingerprint (the digest includes the rules), so local copies never expire
+    cache = TwoTierCache('fingerprint_memo', capacity=__CAPACITY__, local_ttl=None, ttl=__TTL__)
+
+    @classmethod
+    def digest(cls, trace, normalizer, top_frames=0):
+        # the fingerprint depends on the normalization rules, the fingerprinting mode and the SimHash version
+        digest = hashlib.md5(normalizer.version)
+        digest.update('\0{0}\0{1}\0'.format(top_frames, __SIM_HASH_VERSION__))
+        if isinstance(trace, unicode):
+            # encode one chunk at a time, to avoid a copy of huge traces
+            for start in range(0, len(trace), FingerprintMemo.__CHUNK_SIZE__):
+                digest.update(trace[start:start + FingerprintMemo.__CHUNK_SIZE__].encode('utf-8'))
+        else:
+            digest.update(trace)
+        return digest.hexdigest()
+
+    @classmethod
+    def sim_hashes(cls, traces, normalizer, top_frames=0):
+        """
+        Returns the (un-resolved) fingerprint for every trace.
+        When top_frames is specified, traces with in-app frames are fingerprinted using their top frames.
+        """
+        fingerprints = [None] * len(traces)
+        missing = dict()
+        for i, trace in enumerate(traces):
+            if trace:
+                missing.setdefault(FingerprintMemo.digest(trace, normalizer, top_frames=top_frames), list()).append(i)
+
+        cached = FingerprintMemo.cache.get_multi(missing.keys())
+        for digest, fingerprint in cached.iteritems():
+            if fingerprint is not None:
+                for i in missing.pop(digest):
+                    fingerprints[i] = fingerprint
+
+        computed = dict()
+        for digest, indexes in missing.iteritems():
+            fingerprint = CrashReports.compute_fingerprint(traces[indexes[0]], normalizer, top_frames=top_frames)
+            computed[digest] = fingerprint
+            for i in indexes:
+                fingerprints[i] = fingerprint
+
+        if computed:
+            FingerprintMemo.cache.set_multi(computed)
+        return fingerprints
+
+
 class CrashReports(object):
     """
     Encapsulates all the logic for creating/ querying crash reports.
     """
+    @classmethod
+    def normalizer(cls):
+        rule_names = GlobalPreferences.get_property(GlobalPreferences.__NORMALIZATION_RULES__, DEFAULT_RULES)
+        return get_normalizer(rule_names)
+
+    @classmethod
+    def top_frames(cls):
+        value = GlobalPreferences.get_property(GlobalPreferences.__FINGERPRINT_FRAMES__, '0')
+        try:
+            return max(0, int(value))
+        except ValueError:
+            return 0
+
+    @classmethod
+    def compute_fingerprint(cls, report, normalizer, top_frames=0):
+        """
+        Computes the (un-resolved) fingerprint of a single report.
+        """
+        fingerprint = None
+        if top_frames > 0:
+            fingerprint = frame_sim_hash(report, top_frames, normalizer=normalizer)
+        if fingerprint is None:
+            fingerprint = sim_hash(report, normalizer=normalizer)
+        return fingerprint
+
+    @classmethod
+    def fingerprint(cls, report, normalizer=None):
+        return CrashReports.fingerprints([report], normalizer=normalizer)[0]
+
+    @classmethod
+    def fingerprints(cls, reports, normalizer=None):
+        """
+        Computes the fingerprints for a list of reports. Traces are normalized before they are hashed, and
+        new traces are attached to an existing crash when the fingerprint is a near duplicate of a known fingerprint.
+        """
+        if normalizer is None:
+            normalizer = CrashReports.normalizer()
+        fingerprints = FingerprintMemo.sim_hashes(reports, normalizer, top_frames=CrashReports.top_frames())
+        return FingerprintBucket.resolve(fingerprints)
+
     @classmethod
     def add_crash_report(cls, report, argv=None, labels=None):
-        fingerprint = sim_hash(report)
-        crash_report = CrashReport.add_or_remove(fingerprint, report, argv=argv, labels=labels)
-        # add crash report to index
-        Search.add_to_index(crash_report)
+        if CrashReports.write_behind():
+            crash_report = CrashReports.buffer_crash_report(report, argv=argv, labels=labels)
+            if crash_report is not None:
+                return crash_report
+        normalizer = CrashReports.normalizer()
+        fingerprint = CrashReports.fingerprint(report, normalizer=normalizer)
+        crash_report = CrashReport.add_or_remove(
+            fingerprint, report, argv=argv, labels=labels, normalization=normalizer.version,
+            frames=parse_frames(report, normalizer=normalizer))
+        # add crash report to index, while the GitHub integration runs
+        search_rpc = Search.add_crash_reports_async([crash_report])
         # GitHub integration
         # delaying import as there is a circular import
         from github_utils import GithubOrchestrator
         GithubOrchestrator.manage_github_issue(crash_report)
+        Search.wait(search_rpc)
         return crash_report
 
+    @classmethod
+    def async_ingest(cls):
+        value = GlobalPreferences.get_property(GlobalPreferences.__ASYNC_INGEST__, 'false')
+        return value == 'true'
+
+    @classmethod
+    def enqueue_crash_reports(cls, reports):
+        """
+        Fingerprints a batch of reports, and queues them to be added by IngestQueue.drain.
+        Returns the list of fingerprints in the same order as the reports.
+        """
+        fingerprints = CrashReports.fingerprints([report.get('crash') for report in reports])
+        IngestQueue.enqueue(reports, fingerprints)
+        return fingerprints
+
+    @classmethod
+    def write_behind(cls):
+        value = GlobalPreferences.get_property(GlobalPreferences.__WRITE_BEHIND_COUNTERS__, 'false')
+        return value == 'true'
+
+    @classmethod
+    def buffer_crash_report(cls, report, argv=None, labels=None):
+        """
+        Buffers the report of a known crash (see CounterBuffer). Returns the crash report (not stored),
+        or None when the crash has not been seen before, and has to be added synchronously.
+        """
+        normalizer = CrashReports.normalizer()
+        fingerprint = CrashReports.fingerprint(report, normalizer=normalizer)
+        name = CrashReport.key_name(fingerprint)
+        if CrashReport.get_summary(name).get('count', 0) <= 0:
+            return None
+        frames = parse_frames(report, normalizer=normalizer)
+        CounterBuffer.add(
+            fingerprint, report, argv=argv, labels=labels, normalization=normalizer.version, frames=frames)
+        # only used to render the response, the report is stored when the buffer is flushed
+        return CrashReport(
+            key_name=name, name=name, crash=report, fingerprint=fingerprint, argv=argv or [], labels=labels,
+            normalization=normalizer.version, **CrashReport.frame_properties(frames))
+
+    @classmethod
+    def flush_buffered_reports(cls, max_leases=10):
+        """
+        Applies the buffered reports to the counter shards. Returns the number of reports flushed.
+        A report whose lease expires before it is deleted is applied again (at least once semantics).
+        """
+        flushed = 0
+        for lease in range(max_leases):
+            tasks, reports = CounterBuffer.lease()
+            if not tasks:
+                break
+            aggregates = CounterBuffer.aggregate(reports)
+            crash_reports = list()
+            deltas = list()
+            for normalization, by_fingerprint in aggregates.iteritems():
+                batch = CrashReport.add_batch(by_fingerprint, normalization=normalization)
+                crash_reports.extend(batch)
+                deltas.extend(by_fingerprint.get(crash_report.fingerprint).get('delta', 1) for crash_report in batch)
+            CounterBuffer.complete(tasks, aggregates)
+            CrashReports.notify(crash_reports, deltas)
+            flushed += len(tasks)
+            if len(tasks) < CounterBuffer.__LEASE_SIZE__:
+                break
+        return flushed
+
+    @classmethod
+    def add_crash_reports(cls, reports, fingerprints=None):
+        """
+        Adds a batch of crash reports. Each report is a dict with 'crash', 'argv' and 'labels'.
+        Reports are grouped by fingerprint, so that every fingerprint costs a single shard update.
+        fingerprints can be passed in, when they were already computed (e.g. at enqueue time).
+        Returns the list of fingerprints in the same order as the reports.
+        """
+        fingerprints, crash_reports, deltas = CrashReports.count_crash_reports(reports, fingerprints=fingerprints)
+        CrashReports.notify(crash_reports, deltas)
+        return fingerprints
+
+    @classmethod
+    def count_crash_reports(cls, reports, fingerprints=None):
+        """
+        Applies a batch of crash reports to the counter shards, without indexing them or notifying GitHub.
+        Returns a tuple of (fingerprints in the same order as the reports, updated crash reports, their deltas).
+        """
+        normalizer = CrashReports.normalizer()
+        if fingerprints is None:
+            fingerprints = CrashReports.fingerprints(
+                [report.get('crash') for report in reports], normalizer=normalizer)
+        aggregates = dict()
+        for report, fingerprint in zip(reports, fingerprints):
+            crash = report.get('crash')
+            if fingerprint in aggregates:
+                aggregates[fingerprint]['delta'] += 1
+            else:
+                aggregates[fingerprint] = {
+                    'crash': crash,
+                    'argv': report.get('argv'),
+                    'labels': report.get('labels'),
+                    'frames': parse_frames(crash, normalizer=normalizer),
+                    'delta': 1
+                }
+
+        crash_reports = CrashReport.add_batch(aggregates, normalization=normalizer.version)
+        deltas = [aggregates.get(crash_report.fingerprint).get('delta', 1) for crash_report in crash_reports]
+        return fingerprints, crash_reports, deltas
+
+    @classmethod
+    def notify(cls, crash_reports, deltas):
+        """
+        Indexes counted crash reports, and runs the GitHub integration for them. This is best effort: the counts
+        are already applied, so a failure is logged, and never fails (and retries) the request that counted them.
+        """
+        # delaying import as there is a circular import
+        from github_utils import GithubOrchestrator
+        try:
+            # add all crash reports to the index in one call, while the GitHub integration runs
+            search_rpc = Search.add_crash_reports_async(crash_reports)
+        except Exception:
+            logging.exception('Unable to index %s crash reports', len(crash_reports))
+            search_rpc = None
+        for crash_report, delta in zip(crash_reports, deltas):
+            try:
+                GithubOrchestrator.manage_github_issue(crash_report, delta=delta)
+            except Exception:
+                logging.exception('Unable to manage the GitHub issue of %s', crash_report.name)
+        try:
+            Search.wait(search_rpc)
+        except Exception:
+            logging.exception('Unable to index %s crash reports', len(crash_reports))
+
     @classmethod
     def update_report_state(cls, fingerprint, new_state):
         # state can be one of 'unresolved'|'pending'|'submitted'|'resolved'
@@ -75,10 +317,12 @@ class CrashReports(object):
     @classmethod
     def update_crash_report(cls, fingerprint, delta_state):
         name = CrashReport.key_name(fingerprint)
-        to_update = list()
-        q = CrashReport.all()
-        q.filter('name = ', name)
-        for crash_report in q.run():
+
+        def txn(key):
+            # re-read the shard, so that concurrent increments are not overwritten
+            crash_report = CrashReport.get(key)
+            if crash_report is None:
+                return None
             # update state
             # only allow * mutable * properties of crash reports to be updated
 
@@ -96,44 +340,153 @@ class CrashReports(object):
                 crash_report.issue = delta_state.get('issue')
             if 'state' in delta_state:
                 crash_report.state = delta_state.get('state')
+            crash_report.put()
+            return crash_report
 
-            to_update.append(crash_report)
-
-        # update datastore and search indexes
-        db.put(to_update)
-        Search.add_crash_reports(to_update)
-        # clear memcache
-        CrashReport.clear_properties_cache(name)
+        # every shard is updated in its own transaction, and the transactions run concurrently
+        keys = [crash_report.key() for crash_report in CrashReport.get_shards(name)]
+        to_update = [crash_report for crash_report in
+                     run_in_parallel(lambda key: db.run_in_transaction(txn, key), [(key,) for key in keys])
+                     if crash_report is not None]
+        # update the search indexes, while the summary is written through to memcache
+        search_rpc = Search.add_crash_reports_async(to_update)
+        CrashSummary.update(name, delta_state)
+        Search.wait(search_rpc)
         # return crash report
-        return CrashReport.get_crash(fingerprint)
+        return to_update[0] if to_update else CrashReport.get_crash(fingerprint)
 
     @classmethod
-    def trending(cls, start=None, limit=20):
+    @memoize('crashes_for_file', ttl=60, local_ttl=10, negative_ttl=0)
+    def crashes_for_file(cls, file_name, cursor=None, limit=25):
+        """
+        Finds crashes with a stack frame in a given file (either a path or a base name).
+        Results are memoized for a minute.
+        """
         q = CrashReport.all()
-        # only search for crashes that are not resolved
-        q.filter('state IN ', ['unresolved', 'pending', 'submitted'])
-
-        if start:
-            q.filter('__key__ >', Key(start))
-        q.order('__key__')
-        q.order('name')
-        q.order('-count')
+        q.filter('frame_files =', file_name)
+        if cursor:
+            q.with_cursor(cursor)
 
         uniques = set()
-        trending = list()
-        has_more = False
-        for crash_report in q.run():
-            if len(uniques) > limit:
-                has_more = True
-                break
-            else:
-                if crash_report.name not in uniques:
-                    uniques.add(crash_report.name)
-                    crash_report = CrashReport.get_crash(crash_report.fingerprint)
-                    trending.append(CrashReport.to_json(crash_report))
+        crashes = list()
+        crash_reports = q.fetch(limit=limit)
+        for crash_report in crash_reports:
+            if crash_report.name not in uniques:
+                uniques.add(crash_report.name)
+                crashes.append(CrashReport.to_json(crash_report))
 
-        trending = sorted(trending, key=lambda report: report['count'], reverse=True)
+        return {
+            'cursor': q.cursor() if len(crash_reports) >= limit else None,
+            'results': crashes
+        }
+
+    @classmethod
+    def trending(cls, start=None, limit=20):
+        """
+        Returns the hottest unresolved crashes, ranked by their time decayed score.
+        start is the offset into the leaderboard.
+        """
+        try:
+            start = max(0, int(start or 0))
+        except ValueError:
+            start = 0
+        leaderboard = TrendingLeaderboard.top()
+        names = [name for hotness, name in leaderboard]
+        summaries = CrashReport.get_summaries(names)
+        now = datetime.datetime.utcnow()
+        open_names = [name for name in names
+                      if summaries.get(name, dict()).get('state') in TrendingLeaderboard.__OPEN_STATES__]
+        counts = CrashReport.get_counts(open_names[start:start + limit], summaries=summaries)
+        trending = list()
+        for name in open_names[start:start + limit]:
+            summary = summaries.get(name)
+            trending.append({
+                'key': name,
+                'crash': summary.get('snippet'),
+                'argv': summary.get('argv'),
+                'labels': summary.get('labels'),
+                'fingerprint': summary.get('fingerprint'),
+                'time': summary.get('time'),  # in millis
+                'count': counts.get(name),
+                'state': summary.get('state'),
+                'issue': summary.get('issue'),
+                'score': CrashSummary.score(summary.get('hotness'), now)
+            })
+        has_more = len(open_names) > start + limit
         return {
             'trending': trending,
-            'has_more': has_more
+            'has_more': has_more,
+            'next': start + limit if has_more else None
         }
+
+
+class IngestQueue(object):
+    """
+    Crash reports submitted asynchronously are appended to a pull queue, and added in bulk by a worker task.
+    """
+    __QUEUE_NAME__ = 'ingest-queue'
+    # the task queue API accepts at most 100 tasks per call
+    __ADD_BATCH_SIZE__ = 100
+    __LEASE_SIZE__ = 500
+    __LEASE_SECONDS__ = 300
+    # a drain is scheduled at most once per interval (in seconds)
+    __DRAIN_INTERVAL__ = 10
+
+    @classmethod
+    def enqueue(cls, reports, fingerprints):
+        tasks = list()
+        for report, fingerprint in zip(reports, fingerprints):
+            if fingerprint is None:
+                # an empty crash, which cannot be counted
+                logging.warning('Not queueing a crash report without a fingerprint')
+                continue
+            payload = json.dumps({
+                'crash': report.get('crash'),
+                'argv': report.get('argv'),
+                'labels': report.get('labels'),
+                'fingerprint': fingerprint
+            })
+            tasks.append(taskqueue.Task(payload=payload, method='PULL'))
+        queue = taskqueue.Queue(IngestQueue.__QUEUE_NAME__)
+        for start in range(0, len(tasks), IngestQueue.__ADD_BATCH_SIZE__):
+            queue.add(tasks[start:start + IngestQueue.__ADD_BATCH_SIZE__])
+        if tasks:
+            IngestQueue.drain_later()
+
+    @classmethod
+    def drain_later(cls):
+        interval = int(time.time()) // IngestQueue.__DRAIN_INTERVAL__
+        try:
+            deferred.defer(IngestQueue.drain, _countdown=IngestQueue.__DRAIN_INTERVAL__,
+                           _name='drain-ingest-{0}'.format(interval))
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            # a drain is already scheduled
+            pass
+
+    @classmethod
+    def drain(cls):
+        """
+        Leases the queued reports, and counts them. The tasks are deleted as soon as the counts are applied.
+        Returns the number of reports drained. Reports that cannot be counted (e.g. without a fingerprint)
+        are dropped, so they never block the queue. Reports of a failed drain are leased again once their lease
+        expires, by the drain scheduled by the next enqueue or by cron (/tasks/ingest/drain).
+        """
+        queue = taskqueue.Queue(IngestQueue.__QUEUE_NAME__)
+        tasks = queue.lease_tasks(IngestQueue.__LEASE_SECONDS__, IngestQueue.__LEASE_SIZE__)
+        if not tasks:
+            return 0
+        reports = [json.loads(task.payload) for task in tasks]
+        valid = [report for report in reports if report.get('fingerprint') and report.get('crash')]
+        if len(valid) < len(reports):
+            logging.warning('Dropping %s queued crash reports without a crash or fingerprint',
+                            len(reports) - len(valid))
+        fingerprints, crash_reports, deltas = CrashReports.count_crash_reports(
+            valid, fingerprints=[report.get('fingerprint') for report in valid])
+        # the reports are counted, complete them before anything else can fail and have them counted again
+        queue.delete_tasks(tasks)
+        CrashReports.notify(crash_reports, deltas)
+        logging.info('Added %s queued crash reports', len(valid))
+        if len(tasks) >= IngestQueue.__LEASE_SIZE__:
+            # there might be more
+            deferred.defer(IngestQueue.drain)
+        return len(tasks)